@@ -1,11 +1,14 @@
 import copy
+import numpy as np
 import theano
 import theano.tensor as T
+from theano.sandbox.rng_mrg import MRG_RandomStreams
 
+import initializations
 import utils
 from activations import Activation
 from initializations import Initialization
-from normalizations import weight_norm, batch_norm
+from normalizations import weight_norm, batch_norm, layer_norm
 
 
 class AbsLayer(object):
@@ -21,15 +24,33 @@ class AbsLayer(object):
         pass
 
 
-    def initialize(self):
+    def get_param_values(self):
+        """
+            Generate the numpy values of the parameters. A layer without
+            parameters returns None.
+        """
+        return None
+
+
+    def initialize(self, param_values=None, deferred=False):
         """
             Initialize the values of the parameters according to their param_dict. In this dict,
             each parameter key map to a initilization method and an attribute self.key
             will be set
+
+            param_values := values returned by get_param_values, possibly computed in
+            another process. They are generated here if None.
         """
         self.params = []
 
 
+    def materialize(self, values=None):
+        """
+            Set the values of parameters initialized with deferred=True
+        """
+        pass
+
+
     def set_io_dims(self, tup):
         """
             This set the input output dims of the layer. By default input_dims = output_dims
@@ -77,7 +98,7 @@ class RandomLayer(AbsLayer):
         # you can use this class as a second inheritence  lets not try to init twice AbsLayer
         if not hasattr(self, "input_dims"):
             super(RandomLayer, self).__init__(**kwargs)
-        self.rng_theano = theano.sandbox.rng_mrg.MRG_RandomStreams(seed)
+        self.rng_theano = MRG_RandomStreams(seed)
 
 
 
@@ -87,7 +108,9 @@ class Layer(AbsLayer):
     """
     def __init__(self, attr_error_tolerance='warn', initialization=Initialization({}),
                  prefix=None, use_bias=None, batch_norm=None, gamma_scale=None, activation=None,
-                 weight_norm=None, train_g=None, **kwargs):
+                 weight_norm=None, train_g=None, ghost_batch_size=None,
+                 bn_time_statistics=None, tied_to=None, layer_norm=None, init_seed=None,
+                 **kwargs):
         super(Layer, self).__init__(**kwargs)
 
         self.attr_error_tolerance = attr_error_tolerance
@@ -108,6 +131,16 @@ class Layer(AbsLayer):
         else :
             self.bn_mean_only = False
         self.record_batch_norm_mean = False
+        # batch norm statistics on virtual batches of that size (see normalizations.batch_norm)
+        self.ghost_batch_size = ghost_batch_size
+        # on tbc / tbc01, 'shared' over time (default) or 'per_step' batch norm statistics
+        self.bn_time_statistics = bn_time_statistics
+        # reuse the W of this other layer instead of having one (see tie_weights)
+        self.tied_to = tied_to
+        # normalization without batch statistics, used if batch_norm is not set
+        self.layer_norm = layer_norm
+        # seed of the parameter streams, None is initializations.SEED (see get_rng)
+        self.init_seed = init_seed
 
 
     def set_attributes(self, dict_of_hyperparam) :
@@ -135,28 +168,70 @@ class Layer(AbsLayer):
                 self.attribute_error(attr_name)
 
 
-    def initialize(self) :
-        self.params = []
+    def get_param_value(self, key):
+        """
+            Generate the value of param key of the param_dict
+        """
+        value = self.param_dict[key]
+        # each param has its own stream, seeded by its name
+        rng = initializations.get_rng('%s_'%self.prefix+key, self.init_seed)
+        try :
+            if len(value) < 3 or value[2] is None :
+                scaling = 1
+            else :
+                scaling = value[2]
+
+            if self.initialization.has_var(key):
+                param = self.initialization.get_init_tensor(key, value[0], rng)
+            else:
+                param = self.initialization.get_old_init_method(value[1], value[0],
+                                                                scaling, rng)
+            #param = initialization_method[value[1]](value[0]) * scaling
+        except TypeError:
+            raise TypeError("Key: "+ self.prefix+key +" caused an error in initialization")
+        return param
+
+
+    def get_param_values(self):
         self.param_dict_initialization()
-        if self.batch_norm:
+        if self.batch_norm or self.layer_norm:
             self.batch_norm_addparams()
 
+        param_values = {}
+        for key in self.param_dict.keys() :
+            if key == 'W' and self.tied_to is not None:
+                continue
+            param_values[key] = self.get_param_value(key)
+        return param_values
+
+
+    def initialize(self, param_values=None, deferred=False) :
+        """
+            deferred := only the shapes are registered, the shared variables are created
+            empty (with the right ndim) so a graph can be built, and the values are generated
+            or loaded from a checkpoint later on by materialize.
+        """
+        if param_values is None and not deferred:
+            param_values = self.get_param_values()
+        else:
+            # the param_dict is still needed, ex.: by the scan layers
+            self.param_dict_initialization()
+            if self.batch_norm or self.layer_norm:
+                self.batch_norm_addparams()
+
+        self.params = []
+        self.deferred_params = {}
         for key, value in self.param_dict.iteritems() :
-            try :
-                if len(value) < 3 or value[2] is None :
-                    scaling = 1
-                else :
-                    scaling = value[2]
-
-                if self.initialization.has_var(key):
-                    param = self.initialization.get_init_tensor(key, value[0])
-                else:
-                    param = self.initialization.get_old_init_method(value[1], value[0], scaling)
-                #param = initialization_method[value[1]](value[0]) * scaling
-            except TypeError:
-                import ipdb ; ipdb.set_trace()
-                raise TypeError("Key: "+ self.prefix+key +" caused an error in initialization")
-            param = theano.shared(param, name='%s_'%self.prefix+key)
+            if key == 'W' and self.tied_to is not None:
+                self.tie_weights()
+                continue
+            if deferred:
+                ndim = len(utils.parse_tuple(value[0]))
+                param = theano.shared(np.zeros((0,) * ndim, dtype=np.float32),
+                                      name='%s_'%self.prefix+key)
+                self.deferred_params[key] = param
+            else:
+                param = theano.shared(param_values[key], name='%s_'%self.prefix+key)
             setattr(self, key, param)
             self.params += [param]
 
@@ -165,6 +240,58 @@ class Layer(AbsLayer):
             weight_norm(self, self.train_g)
 
 
+    def tie_weights(self):
+        """
+            Set self.W to the W of self.tied_to, which has to be initialized first. The two
+            first axes are swapped if that gives the shape this layer expects, this is the
+            mirror case (FullyConnectedLayer (in,out) -> (out,in), ConvLayer -> DeConvLayer
+            as DeConvLayer.convolve transposes its W back). Else the shapes have to match.
+            The shared variable is in the params of both layers, Feedforward.params counts it once.
+        """
+        shape = utils.parse_tuple(self.param_dict['W'][0])
+        tied_shape = utils.parse_tuple(self.tied_to.param_dict['W'][0])
+        # the shared, not a weight normalized expression of it
+        W = [p for p in self.tied_to.params if p.name == '%s_W'%self.tied_to.prefix]
+        if len(W) == 0:
+            raise AttributeError("{} is tied to {} which has no W, is it initialized?".format(
+                self.prefix, self.tied_to.prefix))
+        W = W[0]
+
+        pattern = (1,0) + tuple(range(2, len(shape)))
+        if tuple(tied_shape[i] for i in pattern) == shape:
+            self.W = W.dimshuffle(*pattern)
+        elif tied_shape == shape:
+            self.W = W
+        else:
+            raise ValueError("Cannot tie W {} of {} to W {} of {}".format(
+                shape, self.prefix, tied_shape, self.tied_to.prefix))
+        self.params += [W]
+
+
+    def materialize(self, values=None):
+        """
+            Set the values of the parameters left empty by initialize(deferred=True).
+            values := {param name : array}, ex.: a checkpoint from utils.load_checkpoint.
+            The parameters not in it are generated.
+        """
+        values = {} if values is None else values
+        for key, param in self.deferred_params.iteritems():
+            if param.name in values:
+                value = values[param.name]
+                shape = utils.parse_tuple(self.param_dict[key][0])
+                if value.shape != shape:
+                    raise ValueError("Loaded {} has shape {} instead of {}".format(
+                        param.name, value.shape, shape))
+            else:
+                value = self.get_param_value(key)
+            param.set_value(value)
+        # params not coming from the param_dict (ex.: weight norm g) are only loaded
+        for param in self.params:
+            if param not in self.deferred_params.values() and param.name in values:
+                param.set_value(values[param.name])
+        self.deferred_params = {}
+
+
     def apply_bias(self, x):
         """
             Why a method even for this?? Because for example convolution
@@ -191,14 +318,15 @@ class Layer(AbsLayer):
         det = kwargs.get('deterministic', False)
         wn_init = kwargs.pop('wn_init', False)
 
-        preact = self.apply(x, **kwargs)
+        # an apply(x) does not take the inference kwargs (ex.: deterministic)
+        preact = self.apply(x, **utils.accepted_kwargs(self.apply, kwargs))
 
-        if self.batch_norm:
-            preact = self.bn(preact, self.betas, self.gammas, deterministic=det)
+        if self.batch_norm or self.layer_norm:
+            preact = self.normalize(preact, self.betas, self.gammas, deterministic=det)
         if wn_init:
+            # the bias is part of what init_wn returns
             preact = self.init_wn(preact)
-
-        if not self.batch_norm and self.use_bias:
+        elif not (self.batch_norm or self.layer_norm) and self.use_bias:
             preact = self.apply_bias(preact)
 
         if self.activation is not None:
@@ -216,17 +344,36 @@ class Layer(AbsLayer):
 
 
     # -------- Normalization related functions -------------- #
+    # the gammas (and betas) are the same for batch norm and layer norm
     def batch_norm_addparams(self):
             self.param_dict.update({
                 'gammas' : [self.output_dims[0], 'ones', self.gamma_scale]
             })
 
 
+    def normalize(self, x, betas, gammas, key='', deterministic=False):
+        """
+            batch norm if it is set, else layer norm
+        """
+        if self.batch_norm:
+            return self.bn(x, betas, gammas, key, deterministic)
+        return layer_norm(x, betas, gammas)
+
+
     def bn(self, x, betas, gammas, key='', deterministic=False):
         if deterministic:
             print "hoollallalaa"
             return (x-self.avg_batch_mean) / T.sqrt(1e-6 + self.avg_batch_var)
-        rval, mean, var = batch_norm(x, betas, gammas, self.bn_mean_only)
+        rval, mean, var = batch_norm(x, betas, gammas, self.bn_mean_only,
+                                     self.ghost_batch_size,
+                                     self.bn_time_statistics or 'shared')
+        if x.ndim in [3, 5] and self.bn_time_statistics == 'per_step':
+            # the running averages are shared over time so inference works on any
+            # sequence length, pool the statistics of every step
+            var = var.mean(axis=0, keepdims=True) + \
+                    T.mean(T.sqr(mean - mean.mean(axis=0, keepdims=True)),
+                           axis=0, keepdims=True)
+            mean = mean.mean(axis=0, keepdims=True)
         if not hasattr(self, 'avg_batch_mean'):
             self.avg_batch_mean = T.zeros_like(mean)
             self.avg_batch_var = T.ones_like(var)
@@ -239,15 +386,37 @@ class Layer(AbsLayer):
         return rval
 
 
-    #FIXME: the dimshuffle on the mean and var depends on their dim. Easy for 2&4D, but for a 5D or 3D tensor?
     def init_wn(self, x, init_stdv=0.1):
-        raise NotImplementedError("You can use wn for now by doing batch norm on first layer")
-        m = T.mean(x, self.wn_axes_to_sum)
-        x -= m.dimshuffle(*self.wn_dimshuffle_args)
-        inv_stdv = init_stdv/T.sqrt(T.mean(T.square(x), self.wn_axes_to_sum))
-        x *= inv_stdv.dimshuffle(*self.wn_dimshuffle_args)
-        self.wn_updates = [(self.betas, -m*inv_stdv), (self.g, self.g*inv_stdv)]
+        """
+            Data dependent init of a weight normalized layer (Salimans & Kingma 2016).
+            x is the preactivation without bias, its statistics are taken on every axis but
+            the channel one. Returns x as it will be after the init so the following layers
+            see the right statistics in the same pass, self.wn_updates holds the new betas / g.
+        """
+        i = 2 if x.ndim in [3, 5] else 1
+        axes = tuple(j for j in range(x.ndim) if j != i)
+        pattern = ['x'] * x.ndim
+        pattern[i] = 0
 
+        self.wn_updates = []
+        if self.use_bias:
+            m = T.mean(x, axes)
+            x = x - m.dimshuffle(*pattern)
+        if not hasattr(self, 'g'):
+            print "WARNING: {} has weight norm without g, only its bias is initialized".format(
+                self.prefix)
+            if self.use_bias:
+                self.wn_updates += [(self.betas, T.zeros_like(self.betas) - m)]
+            return x
+
+        inv_stdv = init_stdv / T.sqrt(1e-6 + T.mean(T.square(x), axes))
+        x = x * inv_stdv.dimshuffle(*pattern)
+        self.wn_updates += [(self.g, self.g * inv_stdv)]
+        if self.use_bias:
+            # untied biases get the same value at every position
+            betas = -m * inv_stdv
+            betas = betas.dimshuffle(*((0,) + ('x',) * (self.betas.ndim - 1)))
+            self.wn_updates += [(self.betas, T.zeros_like(self.betas) + betas)]
         return x
     # ------------------------------------------------------- #
 
@@ -267,10 +436,14 @@ class RecurrentLayer(AbsLayer):
         This class, with ScanLayer class, is intended to handle all these cases.
         NOTE: It should be possible to use a non scanlayer for the time application, in this
         case if no step is implemented, this class will call the fprop of that layer.
+
+        time_chunk := on a 5D input, the upwardlayer sees time and batch collapsed together.
+        If not None, it is done time_chunk time steps at a time to bound the peak memory.
     """
-    def __init__(self, upwardlayer, scanlayer, mode='auto'):
+    def __init__(self, upwardlayer, scanlayer, mode='auto', time_chunk=None):
         assert mode in ['scan', 'out2in', 'auto']
         self.mode = mode
+        self.time_chunk = time_chunk
         self.upwardlayer = upwardlayer
         self.scanlayer = scanlayer
 
@@ -302,13 +475,28 @@ class RecurrentLayer(AbsLayer):
 
 
     def set_attributes(self, attributes):
-        self.upwardlayer.set_attributes(attributes)
+        # on a sequence the upwardlayer sees time and batch collapsed, a fixed batch size
+        # (ex.: static shapes of a conv) only holds for the scanlayer
+        self.upwardlayer.set_attributes(
+            dict((k, v) for k, v in attributes.iteritems() if k != 'batch_size'))
         self.scanlayer.set_attributes(attributes)
 
 
-    def initialize(self):
-        self.upwardlayer.initialize()
-        self.scanlayer.initialize()
+    def get_param_values(self):
+        return (self.upwardlayer.get_param_values(),
+                self.scanlayer.get_param_values())
+
+
+    def initialize(self, param_values=None, deferred=False):
+        if param_values is None:
+            param_values = (None, None)
+        self.upwardlayer.initialize(param_values=param_values[0], deferred=deferred)
+        self.scanlayer.initialize(param_values=param_values[1], deferred=deferred)
+
+
+    def materialize(self, values=None):
+        self.upwardlayer.materialize(values)
+        self.scanlayer.materialize(values)
 
 
     def set_io_dims(self, tup):
@@ -341,12 +529,17 @@ class RecurrentLayer(AbsLayer):
         if x.ndim in [2, 4]:
             assert mode == 'out2in'
         # collapse batch and time together
-        # TODO: modify this so the collapse is optional
         if x.ndim == 5:
-            in_up  = x.reshape((x.shape[0]*x.shape[1],x.shape[2],x.shape[3],x.shape[4]))
+            time_chunk = self.time_chunk
+            if time_chunk is not None and (getattr(self.upwardlayer, 'batch_norm', False)
+                                           or kwargs.get('wn_init', False)):
+                print "WARNING: normalization statistics are over the whole collapsed batch," +\
+                        " not chunking {} through time".format(self.prefix)
+                time_chunk = None
+            fprop = lambda y: self.upwardlayer.fprop(y, **kwargs)
+            h = utils.apply_on_collapsed_time(fprop, x, time_chunk)
         else:
-            in_up = x
-        h = self.upwardlayer.fprop(in_up, **kwargs)
+            h = self.upwardlayer.fprop(x, **kwargs)
 
         if mode == 'out2in':
             if not hasattr(self.scanlayer, 'step'):
@@ -374,8 +567,8 @@ class RecurrentLayer(AbsLayer):
             y = self.scanlayer.after_scan(almosty)
 
         elif mode == 'scan':
-            tup = (h.shape[-1],) if x.ndim == 3 else (h.shape[-3],h.shape[-2],h.shape[-1])
-            h = h.reshape((x.shape[0], x.shape[1],)+tup)
+            if x.ndim == 3:
+                h = h.reshape((x.shape[0], x.shape[1], h.shape[-1]))
             y = self.scanlayer.apply(h)
 
         return y
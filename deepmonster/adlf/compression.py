@@ -0,0 +1,200 @@
+import numpy as np
+import theano
+import theano.tensor as T
+from theano import sparse
+
+import utils
+from baselayers import RecurrentLayer
+from simple import FullyConnectedLayer, LowRankFullyConnectedLayer
+
+# Tools to shrink trained layers. They all work in place on an initialized Feedforward,
+# the graph has to be rebuilt (fprop) afterwards.
+
+
+def get_weights_value(layer, key='W'):
+    """
+        W can be a shared or, with weight norm, an expression of shared variables
+    """
+    W = getattr(layer, key)
+    return W.get_value() if hasattr(W, 'get_value') else W.eval()
+
+
+def svd_truncate(w, rank=None, max_error=None):
+    """
+        Truncated SVD of the 2D array w. Returns (W_U, W_V, error) where W_U . W_V is
+        the best rank approximation of w and error is its relative frobenius error.
+
+        If rank is None, it is picked as the smallest rank with error <= max_error.
+    """
+    assert rank is not None or max_error is not None
+    U, s, Vt = np.linalg.svd(w.astype(np.float64), full_matrices=False)
+
+    # tail[r] is the error made by keeping only the first r singular values
+    tail = np.sqrt(np.append(np.cumsum((s**2)[::-1])[::-1], 0.))
+    tail /= max(tail[0], 1e-12)
+    if rank is None:
+        rank = int(np.where(tail <= max_error)[0][0])
+    rank = max(1, min(rank, len(s)))
+
+    sqrt_s = np.sqrt(s[:rank])
+    W_U = (U[:,:rank] * sqrt_s).astype(np.float32)
+    W_V = (sqrt_s[:,None] * Vt[:rank]).astype(np.float32)
+    return W_U, W_V, tail[rank]
+
+
+def low_rank_fully_connected(layer, rank=None, max_error=None):
+    """
+        Build an initialized LowRankFullyConnectedLayer out of a trained FullyConnectedLayer.
+        W is factorized by truncated SVD (see svd_truncate), every other parameter (biases,
+        batch norm gammas) is copied. A weight normalized W is folded in the factorization.
+    """
+    w = get_weights_value(layer)
+    W_U, W_V, error = svd_truncate(w, rank, max_error)
+    rank = W_U.shape[1]
+
+    if rank * sum(w.shape) >= w.size:
+        print "WARNING: rank {} of {} does not save anything on a {} W".format(
+            rank, layer.prefix, w.shape)
+
+    batch_norm = 'mean_only' if layer.bn_mean_only else layer.batch_norm
+    lowrank = LowRankFullyConnectedLayer(
+        rank, input_dims=layer.input_dims, output_dims=layer.output_dims,
+        attr_error_tolerance=layer.attr_error_tolerance, initialization=layer.initialization,
+        prefix=layer.prefix, use_bias=layer.use_bias, batch_norm=batch_norm,
+        gamma_scale=layer.gamma_scale, activation=layer.activation,
+        ghost_batch_size=layer.ghost_batch_size,
+        bn_time_statistics=layer.bn_time_statistics, layer_norm=layer.layer_norm,
+        init_seed=layer.init_seed)
+    lowrank.initialize()
+
+    lowrank.W_U.set_value(W_U)
+    lowrank.W_V.set_value(W_V)
+    for key in layer.param_dict.keys():
+        if key == 'W':
+            continue
+        getattr(lowrank, key).set_value(getattr(layer, key).get_value())
+
+    print "Factorized {} W {} at rank {}, relative error {:.4f}, {} -> {} params".format(
+        layer.prefix, w.shape, rank, error, w.size, W_U.size + W_V.size)
+    return lowrank
+
+
+def compress_feedforward(feedforward, rank=None, max_error=None, min_size=0):
+    """
+        Replace in place every FullyConnectedLayer of feedforward which W has more
+        than min_size entries by its low rank factorization. The input projection
+        (upwardlayer) of a RecurrentLayer such as LSTM is also considered.
+    """
+    def can_compress(layer):
+        # subclasses (ScanLSTM, NoiseConditionalLayer, ...) have their own fprop logic
+        return type(layer) is FullyConnectedLayer and \
+                np.prod(layer.param_dict['W'][0]) > min_size
+
+    for i, layer in enumerate(feedforward.layers):
+        if isinstance(layer, RecurrentLayer) and can_compress(layer.upwardlayer):
+            layer.upwardlayer = low_rank_fully_connected(layer.upwardlayer, rank, max_error)
+        elif can_compress(layer):
+            feedforward.layers[i] = low_rank_fully_connected(layer, rank, max_error)
+
+
+class MagnitudePruning(object):
+    """
+        Iterative magnitude pruning of the W of FullyConnectedLayers. Each W is multiplied
+        by a mask kept as a shared variable, so this has to be built after initialize and
+        before the fprop. Every call to prune(t) zeros the smallest weights until the
+        sparsity of the schedule at step t is reached (t can be epochs or iterations):
+
+            sparsity(t) = final + (initial - final) * (1 - (t - start) / (end - start))**3
+
+        Pruned weights are never revived. Once training is done, to_sparse swaps W for a
+        CSR sparse shared on the layers that are sparse enough.
+    """
+    def __init__(self, layers, final_sparsity, start=0, end=10, initial_sparsity=0.):
+        assert 0. <= initial_sparsity <= final_sparsity < 1.
+        self.layers = layers
+        self.final_sparsity = final_sparsity
+        self.initial_sparsity = initial_sparsity
+        self.start = start
+        self.end = end
+
+        for layer in self.layers:
+            self.add_mask(layer)
+
+
+    def add_mask(self, layer):
+        shape = layer.param_dict['W'][0]
+        layer.W_mask = theano.shared(np.ones(shape, dtype=np.float32),
+                                     name='%s_'%layer.prefix+'W_mask')
+        layer.W_dense = layer.W
+        layer.W = layer.W_dense * layer.W_mask
+
+
+    def sparsity(self, t):
+        if t < self.start:
+            return 0.
+        progress = min(1., (t - self.start) / float(max(self.end - self.start, 1)))
+        return self.final_sparsity + \
+                (self.initial_sparsity - self.final_sparsity) * (1. - progress)**3
+
+
+    def prune(self, t):
+        target = self.sparsity(t)
+        for layer in self.layers:
+            mask = layer.W_mask.get_value()
+            w = np.abs(get_weights_value(layer, 'W_dense')) * mask
+            n_pruned = int(target * w.size)
+            if n_pruned <= (mask == 0).sum():
+                continue
+            threshold = np.partition(w, n_pruned - 1, axis=None)[n_pruned - 1]
+            mask *= w > threshold
+            layer.W_mask.set_value(mask)
+
+            # zero them in the saved params too so a checkpoint carries the sparsity
+            if hasattr(layer.W_dense, 'get_value'):
+                layer.W_dense.set_value(layer.W_dense.get_value() * mask)
+            print "Pruned {} to {:.3f} sparsity".format(layer.prefix, 1. - mask.mean())
+
+
+    def to_sparse(self, max_density=0.3):
+        """
+            Swap the masked W for a CSR sparse shared variable on every layer which density
+            is under max_density. Build the (inference) graph after this call.
+        """
+        import scipy.sparse
+        for layer in self.layers:
+            density = layer.W_mask.get_value().mean()
+            if density >= max_density:
+                continue
+            w = get_weights_value(layer, 'W')
+            layer.W = sparse.shared(scipy.sparse.csr_matrix(w),
+                                    name='%s_'%layer.prefix+'W_sparse')
+            print "{} will use a sparse dot, density {:.3f}".format(layer.prefix, density)
+
+
+def benchmark_sparsity(input_dim=2048, output_dim=2048, batch_size=128,
+                       sparsities=(0., 0.5, 0.8, 0.9, 0.95, 0.99), n_runs=20):
+    """
+        Time the dense dot against the sparse one for a FullyConnected W at
+        different sparsities. Returns a list of (sparsity, dense time, sparse time).
+    """
+    import scipy.sparse
+    x = T.fmatrix('x')
+    npx = np.random.random((batch_size, input_dim)).astype(np.float32)
+    results = []
+    for sp in sparsities:
+        w = np.random.normal(size=(input_dim, output_dim)).astype(np.float32)
+        w *= np.random.random(w.shape) >= sp
+        f_dense = theano.function([x], T.dot(x, theano.shared(w)))
+        f_sparse = theano.function(
+            [x], sparse.dot(x, sparse.shared(scipy.sparse.csr_matrix(w))))
+        t_dense = utils.time_function(f_dense, [npx], n_runs)
+        t_sparse = utils.time_function(f_sparse, [npx], n_runs)
+        print "sparsity {:.2f}: dense {:.2f}ms, sparse {:.2f}ms".format(
+            sp, t_dense * 1e3, t_sparse * 1e3)
+        results += [(sp, t_dense, t_sparse)]
+    return results
+
+
+
+if __name__ == '__main__':
+    benchmark_sparsity()
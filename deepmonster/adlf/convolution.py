@@ -10,8 +10,15 @@ from baselayers import Layer
 
 class ConvLayer(Layer) :
     def __init__(self, filter_size, num_filters, strides=(1,1), padding='valid',
-                 tied_bias=True, image_size=None, num_channels=None,
-                 **kwargs):
+                 tied_bias=True, image_size=None, num_channels=None, batch_size=None,
+                 dilation=(1,1), **kwargs):
+        """
+            batch_size := if the batch size is fixed, it is given to theano with the other
+            static shapes so it can pick specialized convolution implementations.
+
+            dilation := the filter taps are dilation apart, a k filter covers
+            dilation * (k - 1) + 1 pixels for the cost of k.
+        """
         super(ConvLayer, self).__init__(**kwargs)
         image_size = utils.parse_tuple(image_size, 2)
         self.image_size = image_size
@@ -30,11 +37,17 @@ class ConvLayer(Layer) :
             self.input_dims = (num_channels, image_size[0], image_size[1])
 
         self.filter_size = utils.parse_tuple(filter_size, 2)
+        self.batch_size = batch_size
+        self.dilation = utils.parse_tuple(dilation, 2)
+
+
+    def get_dilated_filter_size(self):
+        return tuple(d * (k - 1) + 1 for k, d in zip(self.filter_size, self.dilation))
 
 
     def infer_outputdim(self):
         i_dim = self.image_size[0]
-        k_dim = self.filter_size[0]
+        k_dim = self.get_dilated_filter_size()[0]
         s_dim = self.strides[0]
         border_mode = self.padding
         if border_mode == 'valid' :
@@ -62,8 +75,20 @@ class ConvLayer(Layer) :
         self.output_dims = (self.num_filters,) + self.feature_size
 
 
+    def get_input_shape(self):
+        # None is unknown for theano as well
+        return (self.batch_size, self.num_channels) + tuple(self.image_size)
+
+
+    def get_filter_shape(self):
+        return (self.num_filters, self.num_channels) + self.filter_size
+
+
     def convolve(self, x, W, strides, border_mode):
-        return nnet.conv2d(x, W, subsample=strides, border_mode=border_mode)
+        return nnet.conv2d(x, W, input_shape=self.get_input_shape(),
+                           filter_shape=self.get_filter_shape(),
+                           subsample=strides, border_mode=border_mode,
+                           filter_dilation=self.dilation)
 
 
     def param_dict_initialization(self):
@@ -76,7 +101,7 @@ class ConvLayer(Layer) :
             'W' : [(self.num_filters, self.num_channels)+self.filter_size,
                    'norm', 0.1]}
 
-        if self.use_bias or self.batch_norm :
+        if self.use_bias or self.batch_norm or self.layer_norm :
             dict_of_init.update({
                 'betas' : [biases_dim, 'zeros'],
         })
@@ -91,10 +116,21 @@ class ConvLayer(Layer) :
             return x + self.betas.dimshuffle(*pattern)
 
 
+    def lowers_to_gemm(self):
+        """
+            A 1x1 convolution without padding is a dot on the channels
+        """
+        return self.filter_size == (1,1) and \
+                self.padding in ['valid', 'half', 'full', (0,0)]
+
+
     def apply(self, x):
-        if self.filter_size == (1,1) and self.input_dims[1:] == (1,1):
-            out = T.dot(x.flatten(2), self.W.flatten(2).dimshuffle(1,0))
-            out = out[:,:,None,None]
+        if self.lowers_to_gemm():
+            if self.strides != (1,1):
+                x = x[:,:,::self.strides[0],::self.strides[1]]
+            W = self.W.flatten(2).dimshuffle(1,0)
+            out = utils.apply_on_channels(x, lambda y: T.dot(y, W),
+                                          tuple(self.image_size) == (1,1))
         else :
             out = self.convolve(x, self.W, self.strides, self.padding)
 
@@ -103,19 +139,25 @@ class ConvLayer(Layer) :
 
 
 class DeConvLayer(ConvLayer) :
+    def lowers_to_gemm(self):
+        # a strided transposed conv upsamples
+        return self.strides == (1,1) and super(DeConvLayer, self).lowers_to_gemm()
+
+
     # ripped from blocks.conv.ConvolutionalTranspose.original_image_size
     def infer_outputdim(self):
         unused_edge = (0,0)
 
+        filter_size = self.get_dilated_filter_size()
         if self.padding == 'full':
-            border = tuple(k - 1 for k in self.filter_size)
+            border = tuple(k - 1 for k in filter_size)
         elif self.padding == 'half':
-            border = tuple(k // 2 for k in self.filter_size)
+            border = tuple(k // 2 for k in filter_size)
         elif self.padding == 'valid':
             border = [0] * len(self.image_size)
         else :
             border = self.padding
-        tups = zip(self.image_size, self.strides, self.filter_size, border,
+        tups = zip(self.image_size, self.strides, filter_size, border,
                    unused_edge)
 
         out = tuple(s * (i - 1) + k - 2 * p + u for i, s, k, p, u in tups)
@@ -136,13 +178,13 @@ class DeConvLayer(ConvLayer) :
         # **convolution**. We therefore have to invert num_channels and
         # num_filters for W.
         W = W.transpose(1, 0, 2, 3)
-        imshp = (None,) + self._get_outdim()
+        imshp = self.get_input_shape()[:1] + self._get_outdim()
         #kshp = (filter_shape[1], filter_shape[0]) + filter_shape[2:]
         kshp = (self.num_channels, self.num_filters,) + self.filter_size
         #import ipdb; ipdb.set_trace()
         return AbstractConv2d_gradInputs(
             imshp=imshp, kshp=kshp, border_mode=border_mode,
-            subsample=strides)(W, input_, self._get_outdim()[1:])
+            subsample=strides, filter_dilation=self.dilation)(W, input_, self._get_outdim()[1:])
 
 
 
@@ -150,17 +192,90 @@ class DeConvLayer(ConvLayer) :
 # fprop by reshapes. Collapse batch and time axis together
 
 class ConvLayer5D(ConvLayer):
-    def fprop(self, x, **kwargs):
+    """
+        Only the convolution sees time and batch collapsed together, the normalizations,
+        bias and activation of Layer.fprop are applied on the tbc01 output.
+
+        time_chunk := if not None, the collapsed batch is convolved time_chunk time steps
+        at a time (see utils.apply_on_collapsed_time) to bound the peak memory.
+    """
+    def __init__(self, *args, **kwargs):
+        self.time_chunk = kwargs.pop('time_chunk', None)
+        super(ConvLayer5D, self).__init__(*args, **kwargs)
+
+
+    def get_input_shape(self):
+        # the batch the convolution sees is time * batch (or time_chunk * batch)
+        return (None,) + super(ConvLayer5D, self).get_input_shape()[1:]
+
+
+    def apply(self, x):
         if x.ndim == 5:
-            y = x.reshape((x.shape[0]*x.shape[1],x.shape[2],x.shape[3],x.shape[4]))
-            out = super(ConvLayer5D, self).fprop(y)
-            out = out.reshape((x.shape[0],x.shape[1],out.shape[1],out.shape[2],out.shape[3]))
-        else:
-            # act normal
-            out = super(ConvLayer5D, self).fprop(x)
-        return out
+            apply = lambda y: super(ConvLayer5D, self).apply(y)
+            return utils.apply_on_collapsed_time(apply, x, self.time_chunk)
+        # act normal
+        return super(ConvLayer5D, self).apply(x)
+
 
 
-# according to the MRO the only thing it inherits from ConvLayer5D is the fprop
+# according to the MRO the only thing it inherits from ConvLayer5D is the apply
 class DeConvLayer5D(ConvLayer5D, DeConvLayer):
     pass
+
+
+
+if __name__ == '__main__':
+    # 1x1 convolutions and channel-wise dense layers: conv2d / transposes against the gemm lowering
+    from simple import FullyConnectedLayer
+
+    x = T.ftensor4('x')
+    for shape in [(128,256,1,1), (64,256,8,8), (16,256,32,32)]:
+        npx = np.random.random(shape).astype(np.float32)
+
+        conv = ConvLayer(1, 512, num_channels=shape[1], image_size=shape[2:], prefix='conv')
+        conv.set_io_dims(conv.input_dims)
+        conv.initialize()
+        f_gemm = theano.function([x], conv.apply(x))
+        f_conv = theano.function([x], conv.convolve(x, conv.W, conv.strides, conv.padding))
+        assert np.allclose(f_gemm(npx), f_conv(npx), atol=1e-4)
+        print "1x1 conv {}: conv2d {:.2f}ms, gemm {:.2f}ms".format(
+            shape, utils.time_function(f_conv, [npx]) * 1e3,
+            utils.time_function(f_gemm, [npx]) * 1e3)
+
+        fl = FullyConnectedLayer(input_dims=shape[1:], output_dims=512, prefix='fl')
+        fl.initialize()
+        y = x.transpose(0,2,3,1)
+        f_old = theano.function([x], T.dot(y, fl.W).transpose(0,3,1,2))
+        f_new = theano.function([x], fl.apply(x))
+        assert np.allclose(f_old(npx), f_new(npx), atol=1e-4)
+        print "dense on bc01 {}: transposes {:.2f}ms, gemm {:.2f}ms".format(
+            shape, utils.time_function(f_old, [npx]) * 1e3,
+            utils.time_function(f_new, [npx]) * 1e3)
+
+    # 3x3 convolutions: no static shapes against the ones given by the layer
+    for shape in [(64,3,32,32), (64,64,32,32), (64,128,16,16), (64,256,8,8)]:
+        npx = np.random.random(shape).astype(np.float32)
+
+        conv = ConvLayer(3, shape[1], num_channels=shape[1], image_size=shape[2:],
+                         padding='half', batch_size=shape[0], prefix='conv')
+        conv.set_io_dims(conv.input_dims)
+        conv.initialize()
+        f_dyn = theano.function([x], nnet.conv2d(x, conv.W, border_mode='half'))
+        f_static = theano.function([x], conv.apply(x))
+        assert np.allclose(f_dyn(npx), f_static(npx), atol=1e-4)
+        print "3x3 conv {}: no shapes {:.2f}ms, static shapes {:.2f}ms".format(
+            shape, utils.time_function(f_dyn, [npx]) * 1e3,
+            utils.time_function(f_static, [npx]) * 1e3)
+
+    # same 5x5 receptive field: a 5x5 convolution against a 3x3 dilated by 2
+    shape = (64,64,32,32)
+    npx = np.random.random(shape).astype(np.float32)
+    for filter_size, dilation in [(5, 1), (3, 2)]:
+        conv = ConvLayer(filter_size, 64, num_channels=64, image_size=shape[2:],
+                         padding='half', dilation=dilation, prefix='conv')
+        conv.set_io_dims(conv.input_dims)
+        conv.initialize()
+        f = theano.function([x], conv.apply(x))
+        assert f(npx).shape[1:] == conv.output_dims
+        print "{}x{} conv dilation {}: {:.2f}ms".format(
+            filter_size, filter_size, dilation, utils.time_function(f, [npx]) * 1e3)
@@ -0,0 +1,181 @@
+import numpy as np
+import theano
+import theano.tensor as T
+
+import utils
+from baselayers import Layer
+from convolution import ConvLayer
+from simple import FullyConnectedLayer
+
+# Evaluate K checkpoints of the same Feedforward in one graph. Every parameter is stacked
+# on a new leading member axis, the dense layers become one batched gemm and the
+# convolutions one grouped convolution (num_groups=K) instead of K small ones.
+#
+# Inside the graph the activations of the K members are folded in the batch, a
+# (b * K, c, ...) tensor member minor, so every parameter free layer or activation
+# (Reshape, pooling, ...) is applied as is. The first parametric layer sees the input
+# once for all the members.
+#
+# Typical usage :
+#     ff.initialize()
+#     ens = Ensemble(ff, ['ckpt1_parameters.pkl', 'ckpt2_parameters.pkl', ...])
+#     f = theano.function([x], ens.fprop(x))
+
+
+class Ensemble(object):
+    """
+        feedforward := an initialized Feedforward, its layers define the architecture
+        and the parameter names to look for in the checkpoints
+        checkpoints := list of paths (see utils.load_checkpoint) or {param name : array}
+    """
+    def __init__(self, feedforward, checkpoints):
+        self.feedforward = feedforward
+        self.n_members = len(checkpoints)
+        checkpoints = [utils.load_checkpoint(c) if isinstance(c, basestring) else c
+                       for c in checkpoints]
+
+        for layer in feedforward.layers:
+            if not isinstance(layer, Layer):
+                continue
+            if type(layer) not in [FullyConnectedLayer, ConvLayer]:
+                raise NotImplementedError("Ensemble of {} ({}) is not supported".format(
+                    layer.prefix, layer.__class__.__name__))
+            if layer.batch_norm or layer.layer_norm or layer.weight_norm or \
+               layer.tied_to is not None:
+                raise NotImplementedError(
+                    "Ensemble of {} with normalization or tied weights".format(
+                        layer.prefix))
+
+        # {param name : shared of the K stacked values}
+        self.params = {}
+        for layer in feedforward.layers:
+            for param in getattr(layer, 'params', []):
+                value = np.stack([np.asarray(c[param.name]) for c in checkpoints])
+                self.params[param.name] = theano.shared(
+                    value.astype(np.float32), name=param.name + '_ensemble')
+
+
+    def get_param(self, layer, key):
+        return self.params['%s_'%layer.prefix + key]
+
+
+    def fold(self, h):
+        # (b, K * c, ...) -> (b * K, c, ...)
+        return h.reshape((h.shape[0] * self.n_members, h.shape[1] // self.n_members) +
+                         tuple(h.shape[i] for i in range(2, h.ndim)), ndim=h.ndim)
+
+
+    def unfold(self, h):
+        # (b * K, c, ...) -> (b, K * c, ...)
+        return h.reshape((h.shape[0] // self.n_members, h.shape[1] * self.n_members) +
+                         tuple(h.shape[i] for i in range(2, h.ndim)), ndim=h.ndim)
+
+
+    def apply_fully_connected(self, layer, h, replicated):
+        if h.ndim != 2:
+            raise NotImplementedError("Ensemble of {} on a {}D input".format(layer.prefix, h.ndim))
+        W = self.get_param(layer, 'W')
+        K = self.n_members
+        if not replicated:
+            # (b, in) . (in, K * out) -> (b, K * out), one gemm for all the members
+            Wcat = W.dimshuffle(1,0,2).reshape((W.shape[1], K * W.shape[2]))
+            out = T.dot(h, Wcat)
+        else:
+            # (K, b, in) x (K, in, out) -> (K, b, out)
+            y = h.reshape((h.shape[0] // K, K, h.shape[1])).dimshuffle(1,0,2)
+            out = T.batched_dot(y, W)
+            out = out.dimshuffle(1,0,2).reshape((out.shape[1], K * out.shape[2]))
+        if layer.use_bias:
+            out = out + self.get_param(layer, 'betas').flatten().dimshuffle('x',0)
+        return self.fold(out)
+
+
+    def apply_convolution(self, layer, h, replicated):
+        W = self.get_param(layer, 'W')
+        K = self.n_members
+        # (K, F, C, k, k) -> (K * F, C, k, k), the members are the groups
+        Wcat = W.reshape((K * W.shape[1],) + tuple(W.shape[i] for i in range(2, 5)), ndim=4)
+        if replicated:
+            h = self.unfold(h)
+        out = T.nnet.conv2d(h, Wcat, subsample=layer.strides, border_mode=layer.padding,
+                            filter_dilation=layer.dilation,
+                            num_groups=K if replicated else 1)
+        if layer.use_bias:
+            betas = self.get_param(layer, 'betas')
+            if layer.tied_bias:
+                out = out + betas.flatten().dimshuffle('x',0,'x','x')
+            else:
+                betas = betas.reshape((K * betas.shape[1], betas.shape[2], betas.shape[3]))
+                out = out + betas.dimshuffle('x',0,1,2)
+        return self.fold(out)
+
+
+    def fprop(self, x, output='mean'):
+        """
+            output := 'mean' for the average over the members of the output (the logits
+            if the last layer has no activation), 'members' for all of them stacked
+            on a leading axis (K, b, ...)
+        """
+        assert output in ['mean', 'members']
+        h = x
+        replicated = False
+        for layer in self.feedforward.layers:
+            if isinstance(layer, FullyConnectedLayer):
+                h = self.apply_fully_connected(layer, h, replicated)
+            elif isinstance(layer, ConvLayer):
+                h = self.apply_convolution(layer, h, replicated)
+            else:
+                h = layer.fprop(h)
+                continue
+            replicated = True
+            if layer.activation is not None:
+                h = layer.activation(h)
+
+        if not replicated:
+            raise ValueError("No parametric layer in " + self.feedforward.prefix)
+        # (b * K, ...) -> (b, K, ...)
+        h = h.reshape((h.shape[0] // self.n_members, self.n_members) +
+                      tuple(h.shape[i] for i in range(1, h.ndim)), ndim=h.ndim+1)
+        if output == 'mean':
+            return h.mean(axis=1)
+        return h.dimshuffle(*(1,0) + tuple(range(2, h.ndim)))
+
+
+
+if __name__ == '__main__':
+    # K checkpoints one after the other against the stacked ensemble
+    from activations import Identity, Rectifier
+    from extras import Reshape
+    from network import Feedforward
+
+    K = 8
+    layers = [
+        ConvLayer(3, 32, num_channels=3, image_size=(32,32), padding='half'),
+        ConvLayer(3, 32, strides=(2,2), padding='half'),
+        Reshape((None, 32*16*16)),
+        FullyConnectedLayer(input_dims=32*16*16, output_dims=10, activation=Identity()),
+    ]
+    ff = Feedforward(layers, 'ens', activation=Rectifier(), use_bias=True)
+    ff.initialize()
+
+    checkpoints = []
+    for k in range(K):
+        checkpoints += [dict((p.name, np.random.normal(scale=0.05, size=p.get_value().shape))
+                             for p in ff.params)]
+
+    x = T.ftensor4('x')
+    npx = np.random.random((64,3,32,32)).astype(np.float32)
+    f_single = theano.function([x], ff.fprop(x))
+    def loop(npx):
+        outs = []
+        for c in checkpoints:
+            for p in ff.params:
+                p.set_value(c[p.name].astype(np.float32))
+            outs += [f_single(npx)]
+        return np.mean(outs, axis=0)
+
+    ens = Ensemble(ff, checkpoints)
+    f_ens = theano.function([x], ens.fprop(x))
+    assert np.allclose(loop(npx), f_ens(npx), atol=1e-4)
+    print "{} members: loop {:.2f}ms, stacked {:.2f}ms".format(
+        K, utils.time_function(loop, [npx]) * 1e3, utils.time_function(f_ens, [npx]) * 1e3)
@@ -1,77 +1,133 @@
+import zlib
 import numpy as np
 
-rng_np = np.random.RandomState(4321)
+SEED = 4321
+rng_np = np.random.RandomState(SEED)
 
 
-def norm_weight_tensor(shape):
-    return np.random.normal(size=shape).astype('float32')
+def get_rng(name, seed=None):
+    """
+        RandomState of the parameter with this (full, ex.: prefix_W) name. The stream only
+        depends on the name and the seed, not on the order in which parameters are
+        initialized, so layers can be initialized in any order or concurrently.
+
+        seed := defaults to the module SEED, read at call time so it can be changed
+        at runtime. np.random.seed has no effect on these streams.
+    """
+    if seed is None:
+        seed = SEED
+    return np.random.RandomState((zlib.crc32(name) ^ seed) & 0xffffffff)
+
+
+def randn_float32(shape, rng=None, chunk_size=2**20):
+    """
+        Standard normal float32 array drawn by chunks, the float64 temporary is
+        never bigger than chunk_size. Same stream as rng.randn(*shape).
+    """
+    rng = np.random if rng is None else rng
+    out = np.empty(shape, dtype=np.float32)
+    flat = out.reshape(-1)
+    for i in range(0, flat.size, chunk_size):
+        n = min(chunk_size, flat.size - i)
+        flat[i:i+n] = rng.standard_normal(n)
+    return out
+
+
+# All the init methods take a rng, if None they fall back on the global streams
 
+def norm_weight_tensor(shape, rng=None):
+    return randn_float32(shape, rng)
 
-def orthogonal_weight_tensor(shape):
+
+def orthogonalize(M):
+    """
+        Q of the QR decomposition of M, or of every matrix of M if M is a stack (..., n, n),
+        with the signs fixed so the diagonal of R is positive.
+    """
+    if M.ndim == 2:
+        Q, R = np.linalg.qr(M)
+        return Q * np.sign(np.diag(R))
+
+    try:
+        # stacked qr, numpy >= 1.22
+        Q, R = np.linalg.qr(M)
+        return Q * np.sign(np.diagonal(R, axis1=-2, axis2=-1))[...,None,:]
+    except np.linalg.LinAlgError:
+        pass
+
+    n = M.shape[-1]
+    if n > 16:
+        # big matrices, the python loop on qr is not the bottleneck
+        Q = [orthogonalize(m) for m in M.reshape((-1, n, n))]
+        return np.asarray(Q).reshape(M.shape)
+
+    # small matrices, Gram-Schmidt on the whole stack at once. It gives
+    # a positive diagonal for R without any sign fix.
+    Q = M.astype(np.float64)
+    for j in range(n):
+        v = Q[...,:,j]
+        for i in range(j):
+            v -= (Q[...,:,i] * v).sum(axis=-1)[...,None] * Q[...,:,i]
+        v /= np.sqrt((v * v).sum(axis=-1))[...,None]
+    return Q.astype(M.dtype)
+
+
+def orthogonal_weight_tensor(shape, rng=None):
     """
     Random orthogonal matrix as done in blocks
     Orthogonal() for a 2D or 4D tensor.
     2D: assumes a square or rectangular matrix (will make blocks of orth for rectangular)
     4D: assumes shape[-2:] is square and return orth matrices on these axis
+
+    All the random matrices are drawn at once (same stream as drawing them one by one)
+    and orthogonalized as a stack.
     """
+    rng = rng_np if rng is None else rng
     if len(shape) == 2 :
         if shape[0] == shape[1] :
-            M = rng_np.randn(*shape).astype(np.float32)
-            Q, R = np.linalg.qr(M)
-            Q = Q * np.sign(np.diag(R))
-            return Q
+            M = randn_float32(shape, rng)
+            return orthogonalize(M)
 
         i = 0 if shape[0] > shape[1] else 1
         if shape[i] % shape[i-1] == 0:
             print "WARNING: You asked for a orth initialization of a 2D tensor"+\
                     " which is not square, but it seems possible to make it orth by blocks"
-            weight_tensor = np.empty(shape, dtype=np.float32)
             blocks_of_orth = shape[i] // shape[i-1]
-            for j in range(blocks_of_orth):
-                M = rng_np.randn(shape[1-i],shape[1-i]).astype(np.float32)
-                Q, R = np.linalg.qr(M)
-                Q = Q * np.sign(np.diag(R))
-                if i == 0:
-                    weight_tensor[j*shape[1]:(j+1)*shape[1],:] = Q
-                else:
-                    weight_tensor[:,j*shape[0]:(j+1)*shape[0]] = Q
-            return weight_tensor
+            n = shape[1-i]
+            M = randn_float32((blocks_of_orth, n, n), rng)
+            Q = orthogonalize(M)
+            if i == 0:
+                # blocks stacked on the rows
+                return Q.reshape(shape)
+            # blocks stacked on the columns
+            return Q.transpose(1, 0, 2).reshape(shape)
         else :
             print "WARNING: You asked for a orth initialization of a 2D tensor"+\
                     " that is not square and not square by block. Falling back to norm init."
-            return norm_weight_tensor(shape)
+            return norm_weight_tensor(shape, rng)
 
     elif len(shape) == 3 :
         print "WARNING: You asked for a orth initialization for 3D tensor"+\
                 " it is not implemented. Falling back to norm init."
-        return norm_weight_tensor(shape)
+        return norm_weight_tensor(shape, rng)
 
     assert shape[2] == shape[3]
     if shape[2] == 1 :
-        return norm_weight_tensor(shape)
+        return norm_weight_tensor(shape, rng)
 
-    weight_tensor = np.empty(shape, dtype=np.float32)
-    shape_ = shape[2:]
+    M = randn_float32(shape, rng)
+    return orthogonalize(M)
 
-    for i in range(shape[0]):
-        for j in range(shape[1]) :
-            M = rng_np.randn(*shape_).astype(np.float32)
-            Q, R = np.linalg.qr(M)
-            Q = Q * np.sign(np.diag(R))
-            weight_tensor[i,j,:,:] = Q
-
-    return weight_tensor
 
+def ones_tensor(shape, rng=None):
+    return np.ones(shape, dtype=np.float32)
 
-def ones_tensor(shape):
-    return np.ones(shape).astype(np.float32)
 
+def zeros_tensor(shape, rng=None):
+    return np.zeros(shape, dtype=np.float32)
 
-def zeros_tensor(shape):
-    return np.zeros(shape).astype(np.float32)
 
-
-def identity_tensor(shape):
+def identity_tensor(shape, rng=None):
     assert shape[0] == shape[1]
     return np.identity(shape[0], dtype=np.float32)
 
@@ -105,15 +161,26 @@ class Initialization(object):
         return self.vardict.has_key(varname)
 
 
-    def get_init_tensor(self, varname, shape):
-        return self.vardict[varname](shape)
+    def get_init_tensor(self, varname, shape, rng=None):
+        init = self.vardict[varname]
+        if rng is None:
+            return init(shape)
+        try:
+            return init(shape, rng=rng)
+        except TypeError:
+            # a custom init that doesn't take a rng, it will use the global streams
+            return init(shape)
 
 
-    def get_old_init_method(self, initmethodname, shape, scale=1.):
+    def get_old_init_method(self, initmethodname, shape, scale=1., rng=None):
         """
             Legacy / default compatibility
         """
-        return self.initialization_method[initmethodname](shape) * scale
+        param = self.initialization_method[initmethodname](shape, rng=rng)
+        if scale != 1:
+            # in place, no copy of a possibly big tensor
+            param *= scale
+        return param
 
 
 ### The objects below are wrapper for one particular init method
@@ -123,8 +190,11 @@ class Gaussian(object):
         self.mu = mu
         self.std = std
 
-    def __call__(self, shape):
-        return self.mu + self.std * np.random.randn(*shape).astype(np.float32)
+    def __call__(self, shape, rng=None):
+        param = randn_float32(shape, rng)
+        param *= self.std
+        param += self.mu
+        return param
 
 
 class GaussianHe(object):
@@ -132,9 +202,10 @@ class GaussianHe(object):
         self.axis = axis
         self.coeff = coeff
 
-    def __call__(self, shape):
-        wt = np.random.normal(size=shape).astype('float32')
-        return wt * np.sqrt(2. / ((1. + self.coeff**2) * shape[self.axis]))
+    def __call__(self, shape, rng=None):
+        wt = norm_weight_tensor(shape, rng)
+        wt *= np.sqrt(2. / ((1. + self.coeff**2) * shape[self.axis]))
+        return wt
 
 
 class ScalableInit(object):
@@ -142,19 +213,19 @@ class ScalableInit(object):
         self.scale = scale
 
 class Constant(ScalableInit):
-    def __call__(self, shape):
-        return np.ones(shape).astype(np.float32) * self.scale
+    def __call__(self, shape, rng=None):
+        return np.ones(shape, dtype=np.float32) * self.scale
 
 class Orthogonal(ScalableInit):
-    def __call__(self, shape):
-        return orthogonal_weight_tensor(shape) * self.scale
+    def __call__(self, shape, rng=None):
+        return orthogonal_weight_tensor(shape, rng) * self.scale
 
 class IdentityMatrix(ScalableInit):
     def __init__(self, scale=1., onwhichtuple=(0,1)):
         super(IdentityMatrix, self).__init__(scale)
         self.onwhichtuple = onwhichtuple
 
-    def __call__(self, shape):
+    def __call__(self, shape, rng=None):
         if len(shape) > 2:
             raise NotImplementedError
         assert shape[0] == shape[1]
@@ -164,13 +235,31 @@ class IdentityMatrix(ScalableInit):
 
 
 if __name__ == "__main__":
-    from mlp import FullyConnectedLayer
-    from convolution import ConvOnSequence
-    fl = FullyConnectedLayer(input_size=20, output_size=30, prefix='fl',
-                             weight_norm=True, train_g=True)
-    fl.initialize()
-    conv = ConvOnSequence(3, num_channels=10, num_filters=20,
-                          mem_size_x=5, mem_size_y=5, prefix='conv',
-                          weight_norm=True, train_g=True)
-    conv.initialize()
-    import ipdb; ipdb.set_trace()
+    import time
+    from network import Feedforward
+    from rnn import ConvLSTM
+
+    # U of a 512 filters ScanConvLSTM
+    shape = (4*512, 512, 3, 3)
+    t0 = time.time()
+    orthogonal_weight_tensor(shape)
+    print "Stacked orth init of {}: {:.2f}s".format(shape, time.time() - t0)
+
+    # the former one qr per filter pair, timed on a slice and extrapolated
+    t0 = time.time()
+    for i in range(shape[0] // 64):
+        for j in range(shape[1]):
+            Q, R = np.linalg.qr(rng_np.randn(*shape[2:]).astype(np.float32))
+            Q = Q * np.sign(np.diag(R))
+    print "Loop orth init of {}: {:.2f}s (extrapolated)".format(shape, (time.time() - t0) * 64)
+
+    values = []
+    for processes, pool in [(None, None), (4, 'process'), (4, 'thread')]:
+        layers = [ConvLSTM(3, 256, num_channels=3, image_size=(32,32))] + \
+                [ConvLSTM(3, 256) for i in range(5)]
+        ff = Feedforward(layers, 'convlstm')
+        t0 = time.time()
+        ff.initialize(processes=processes, pool=pool)
+        print "Initialize with {} {}: {:.2f}s".format(processes, pool, time.time() - t0)
+        values += [[p.get_value() for p in ff.params]]
+    assert all(all(np.array_equal(a, b) for a, b in zip(values[0], v)) for v in values[1:])
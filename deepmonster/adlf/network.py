@@ -1,3 +1,18 @@
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import theano
+
+import utils
+from baselayers import Layer, RecurrentLayer
+from scanlayers import ScanLayer
+
+
+def _get_param_values(layer):
+    # module level so it can be sent to a process pool
+    return layer.get_param_values()
+
+
+
 class Feedforward(object):
     """
         Feedforward abstract class managing a series of Layer class.
@@ -17,12 +32,22 @@ class Feedforward(object):
     def __init__(self, layers, prefix, **kwargs):
         self.layers = layers
         self.prefix = prefix
+        # indices of the layers left out of trainable_params
+        self.frozen = set()
         self.dict_of_hyperparam = kwargs
         self.protected_method = [
             '__init__',
             'params',
             'propagate',
             'fprop',
+            'initialize',
+            'materialize',
+            'data_dependent_init',
+            'trainable_params',
+            'freeze',
+            'unfreeze',
+            '_layer_ids',
+            '_set_layer_io_dims',
         ]
 
         set_attr = kwargs.pop('set_attr', True)
@@ -60,12 +85,52 @@ class Feedforward(object):
 
     @property
     def params(self):
+        # a shared variable can be in many layers (see Layer.tie_weights)
         params = []
         for layer in self.layers :
-            params += layer.params
+            params += [p for p in layer.params if p not in params]
         return params
 
 
+    @property
+    def trainable_params(self):
+        """
+            params without the ones of the frozen layers. Give these to the gradient and
+            the optimizer: theano only builds the gradient of what is asked for and the
+            optimizer only makes buffers (ex.: Adam mean and variance) for them. A shared
+            variable in a frozen and a trainable layer (tied weights) is frozen.
+        """
+        frozen = []
+        for i in self.frozen:
+            frozen += self.layers[i].params
+        return [p for p in self.params if p not in frozen]
+
+
+    def _layer_ids(self, layer_ids):
+        if layer_ids is None:
+            return range(len(self.layers))
+        if isinstance(layer_ids, slice):
+            return range(len(self.layers))[layer_ids]
+        if isinstance(layer_ids, int):
+            return [layer_ids]
+        return list(layer_ids)
+
+
+    def freeze(self, layer_ids=None):
+        """
+            Freeze the layers at layer_ids (int, list or slice, all of them if None).
+            It changes trainable_params, the gradient and training function have
+            to be built again after this call.
+        """
+        self.frozen.update(self._layer_ids(layer_ids))
+        print "Frozen layers of {}: {}".format(self.prefix, sorted(self.frozen))
+
+
+    def unfreeze(self, layer_ids=None):
+        self.frozen.difference_update(self._layer_ids(layer_ids))
+        print "Frozen layers of {}: {}".format(self.prefix, sorted(self.frozen))
+
+
     def propagate(self, func, *args, **kwargs):
         """
             Class decorator that takes a func to apply to every layer in the Feedforward chain.
@@ -83,26 +148,121 @@ class Feedforward(object):
         layer.set_attributes(self.dict_of_hyperparam)
 
 
-    def initialize(self, i, layer, **kwargs):
-        #import ipdb; ipdb.set_trace()
-        if i == 0 :
-            if not hasattr(layer, 'input_dims'):
-                raise ValueError("The very first layer of this chain needs its input_dims!")
-            layer.set_io_dims(layer.input_dims)
-        else:
-            layer.set_io_dims(self.layers[i-1].output_dims)
+    def _initialize(self, i, layer, **kwargs):
+        self._set_layer_io_dims(i, layer)
         layer.initialize(**kwargs)
 
 
+    def _set_io_dims(self, i, layer):
+        self._set_layer_io_dims(i, layer)
+
+
+    def _materialize(self, i, layer, values=None):
+        layer.materialize(values)
+
+
     def _fprop(self, i, layer, **kwargs):
         input_id = kwargs.pop('input_id', 0)
         if i < input_id:
             return
-        y = layer.fprop(self.activations_list[-1], **kwargs)
+        # a parameter free layer (ex.: Reshape) can have a fprop(x)
+        y = layer.fprop(self.activations_list[-1],
+                        **utils.accepted_kwargs(layer.fprop, kwargs))
         self.activations_list.append(y)
     # -------------------------------------- #
 
 
+    def _set_layer_io_dims(self, i, layer):
+        if i == 0 :
+            if not hasattr(layer, 'input_dims'):
+                raise ValueError("The very first layer of this chain needs its input_dims!")
+            layer.set_io_dims(layer.input_dims)
+        else:
+            layer.set_io_dims(self.layers[i-1].output_dims)
+
+
+    def initialize(self, processes=None, pool='process', **kwargs):
+        """
+            Set the io dims and initialize every layer in the chain.
+
+            processes := if more than 1, the parameter values are generated concurrently
+            in a pool of that many processes, or threads if pool == 'thread'. Every parameter
+            has its own random stream seeded by its name (see initializations.get_rng),
+            so the values are identical to the sequential initialization. Give
+            init_seed to the constructor to get other values (ex.: ensemble members).
+
+            deferred := (kwarg) only create empty shared variables, the graph can be built
+            right away and the values are set by materialize (from a checkpoint or generated).
+        """
+        assert pool in [None, 'process', 'thread']
+        # with deferred there is nothing to generate, no need for a pool
+        if processes is None or processes <= 1 or kwargs.get('deferred', False):
+            self._initialize(**kwargs)
+            return
+
+        # every shape has to be known before anything is sent to the pool
+        self._set_io_dims()
+        if pool == 'thread':
+            pool = ThreadPool(processes)
+        else:
+            pool = multiprocessing.Pool(processes)
+        try:
+            param_values = pool.map(_get_param_values, self.layers)
+        finally:
+            pool.close()
+            pool.join()
+
+        for layer, values in zip(self.layers, param_values):
+            if values is None:
+                layer.initialize(**kwargs)
+            else:
+                layer.initialize(param_values=values, **kwargs)
+
+
+    def materialize(self, checkpoint=None):
+        """
+            Set the values of every parameter left empty by initialize(deferred=True).
+
+            checkpoint := dict {param name : array} or a path given to utils.load_checkpoint.
+            The parameters found in it are loaded as is without generating their random
+            init first, the missing ones are generated as usual.
+        """
+        if isinstance(checkpoint, basestring):
+            checkpoint = utils.load_checkpoint(checkpoint)
+        self._materialize(values=checkpoint)
+
+
+    def data_dependent_init(self, batch):
+        """
+            Data dependent init of every weight normalized Layer of the chain (see
+            Layer.init_wn). The batch goes through the layers in order, each one seeing
+            the output of the already initialized previous ones, so a single function is
+            compiled and run once for the whole chain.
+        """
+        def can_init(layer):
+            return isinstance(layer, Layer) and not isinstance(layer, ScanLayer) and \
+                    layer.weight_norm and not (layer.batch_norm or layer.layer_norm)
+
+        x = theano.tensor.TensorType(batch.dtype, (False,) * batch.ndim)('x')
+        h = x
+        updates = []
+        for layer in self.layers:
+            target = layer.upwardlayer if isinstance(layer, RecurrentLayer) else layer
+            if can_init(target):
+                h = layer.fprop(h, wn_init=True)
+                # the statistics can be upcasted (ex.: floatX=float64)
+                updates += [(p, theano.tensor.cast(u, p.dtype)) for p, u in target.wn_updates]
+            else:
+                h = layer.fprop(h)
+
+        if len(updates) == 0:
+            print "WARNING: no weight normalized layer to initialize in", self.prefix
+            return
+        f = theano.function([x], [], updates=updates, on_unused_input='ignore')
+        f(batch)
+        print "Data dependent init of {} params in {}".format(len(updates), self.prefix)
+
+
     def fprop(self, x, output_id=-1, **kwargs):
         # inpud_id := use this index to start the fprop at that point in the feedforward block
         # output_id := will return this index, can use 'all' for returning the whole list
@@ -114,3 +274,56 @@ class Feedforward(object):
             return self.activations_list[1:]
         else:
             return self.activations_list[output_id]
+
+
+
+if __name__ == '__main__':
+    # time spent building deep recurrent and conv graphs, before any compilation
+    import time
+    import theano.tensor as T
+    from activations import Rectifier
+    from convolution import ConvLayer
+    from rnn import LSTM
+
+    def build(name, make_layers, x, n_layers):
+        t0 = time.time()
+        ff = Feedforward(make_layers(n_layers), name, activation=Rectifier(), use_bias=True)
+        t1 = time.time()
+        ff.initialize()
+        t2 = time.time()
+        ff.fprop(x)
+        t3 = time.time()
+        print "{} layers {}: construct {:.2f}s, initialize {:.2f}s, fprop {:.2f}s".format(
+            n_layers, name, t1 - t0, t2 - t1, t3 - t2)
+
+    n_layers = 128
+    build('conv',
+          lambda n: [ConvLayer(3, 16, num_channels=16, image_size=(16,16), padding='half')] +
+                    [ConvLayer(3, 16, padding='half') for i in range(n - 1)],
+          T.ftensor4('x'), n_layers)
+    build('lstm',
+          lambda n: [LSTM(32, input_dims=32, mode='scan')] +
+                    [LSTM(32, mode='scan') for i in range(n - 1)],
+          T.ftensor3('x'), n_layers)
+
+    # training step time with every layer trained against the bottom ones frozen
+    import numpy as np
+
+    x = T.ftensor4('x')
+    npx = np.random.random((32,32,32,32)).astype(np.float32)
+    layers = [ConvLayer(3, 32, num_channels=32, image_size=(32,32), padding='half')] + \
+            [ConvLayer(3, 32, padding='half') for i in range(7)]
+    ff = Feedforward(layers, 'frz', activation=Rectifier(), use_bias=True)
+    ff.initialize()
+
+    for frozen in [None, slice(0, 6)]:
+        ff.unfreeze()
+        if frozen is not None:
+            ff.freeze(frozen)
+        cost = T.sqr(ff.fprop(x)).mean()
+        params = ff.trainable_params
+        updates = [(p, p - np.float32(0.01) * g)
+                   for p, g in zip(params, T.grad(cost, params))]
+        f = theano.function([x], cost, updates=updates)
+        print "{} trained params, frozen {}: step {:.2f}ms".format(
+            len(params), sorted(ff.frozen), utils.time_function(f, [npx]) * 1e3)
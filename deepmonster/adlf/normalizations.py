@@ -1,5 +1,7 @@
 import theano
 import theano.tensor as T
+
+import utils
 from initializations import Constant
 
 
@@ -19,7 +21,7 @@ def weight_norm(layer, train_g=None):
         raise AttributeError("Trying to call weight norm on {} without layer.W or layer.U defined".format(layer))
     weights = getattr(layer, weight_tag)
 
-    Wndim = weights.get_value().ndim
+    Wndim = weights.ndim
     if Wndim == 4:
         W_axes_to_sum = (1,2,3)
         W_dimshuffle_args = (0,'x','x','x')
@@ -34,7 +36,9 @@ def weight_norm(layer, train_g=None):
         W_dimshuffle_args = ('x',0)
 
     if train_g is not None:
-        g = init_g(layer.output_dims)
+        # one g per output channel, the axis that is not summed over
+        Wshape = utils.parse_tuple(layer.param_dict[weight_tag][0])
+        g = init_g(Wshape[W_dimshuffle_args.index(0)])
         g = theano.shared(g, name=layer.prefix+'_g')
         if train_g :
             layer.params += [g]
@@ -52,22 +56,77 @@ def weight_norm(layer, train_g=None):
 
 
 
-def batch_norm(x, betas, gammas, bn_mean_only=False):
-    # TODO: make spatial batch_norm optional
+def layer_norm(x, betas, gammas):
+    """
+        Normalize each example (and each time step for tbc / tbc01) over its channels and
+        spatial axes. There is no batch statistic, training and inference are the same
+        graph whatever the batch size. betas and gammas are per channel as for batch_norm.
+    """
+    if x.ndim == 2:
+        axis = [1]
+        pattern = ('x',0)
+    elif x.ndim == 4:
+        axis = [1, 2, 3]
+        pattern = ('x',0,'x','x')
+    elif x.ndim == 3:
+        axis = [2]
+        pattern = ('x','x',0)
+    elif x.ndim == 5:
+        axis = [2, 3, 4]
+        pattern = ('x','x',0,'x','x')
+    else:
+        raise ValueError("Dims {} in layer norm?".format(x.ndim))
+
+    if betas == 0 :
+        pass
+    elif betas.ndim == 1:
+        betas = betas.dimshuffle(pattern)
+    elif betas.ndim == 3:
+        betas = betas.dimshuffle((x.ndim-3)*('x',)+(0,1,2,))
+
+    mean = x.mean(axis=axis, keepdims=True)
+    var = T.mean(T.sqr(x - mean), axis=axis, keepdims=True)
+    return theano.tensor.nnet.bn.batch_normalization(
+        inputs=x, gamma=gammas.dimshuffle(pattern), beta=betas,
+        mean=mean,
+        std=theano.tensor.sqrt(var + 1e-6),
+        mode="low_mem")
+
+
+def batch_norm(x, betas, gammas, bn_mean_only=False, ghost_batch_size=None,
+               time_statistics='shared'):
+    """
+        x can be bc, bc01, tbc or tbc01. The statistics are taken on every axis but
+        the channel one (spatial batch norm), except for bc where they are taken on the
+        features of each example. For tbc and tbc01 time_statistics chooses
+        between statistics shared over time ('shared') and statistics for each time step
+        ('per_step', the returned mean and var then keep the time axis, Layer.bn pools
+        them over time for its running averages).
+
+        ghost_batch_size := if not None, the batch is split in virtual batches of that
+        size (the batch size has to be a multiple of it) and every virtual batch is
+        normalized with its own statistics, all in one reduction on a reshaped x. The
+        returned mean and var are averaged over the virtual batches. For bc, the
+        statistics are then taken over the examples of each virtual batch.
+    """
+    assert time_statistics in ['shared', 'per_step']
     if x.ndim == 2:
-        axis = 1
+        axis = [1]
         pattern = ('x',0)
     elif x.ndim == 4 :
         axis = [0, 2, 3] # this implies spatial batch norm
         pattern = ('x',0,'x','x')
+    elif x.ndim == 3:
+        axis = [0, 1]
+        pattern = ('x','x',0)
+    elif x.ndim == 5:
+        axis = [0, 1, 3, 4]
+        pattern = ('x','x',0,'x','x')
     else:
         raise ValueError("Dims {} in batch norm?".format(x.ndim))
-
-    mean = x.mean(axis=axis, keepdims=True)
-    if not bn_mean_only :
-        var = T.mean(T.sqr(x - mean), axis=axis, keepdims=True)
-    else :
-        var = theano.tensor.ones_like(mean)
+    batch_axis = 1 if x.ndim in [3, 5] else 0
+    if x.ndim in [3, 5] and time_statistics == 'per_step':
+        axis = axis[1:]
 
     if betas == 0 :
         pass
@@ -75,11 +134,63 @@ def batch_norm(x, betas, gammas, bn_mean_only=False):
         betas = betas.dimshuffle(pattern)
     elif betas.ndim == 3:
         betas = betas.dimshuffle((x.ndim-3)*('x',)+(0,1,2,))
+    gammas = gammas.dimshuffle(pattern)
+
+    if ghost_batch_size is not None:
+        if x.ndim == 2:
+            # per example statistics do not depend on the batch, the virtual batches
+            # only make sense over the examples
+            axis = [0]
+        # (..., b, ...) -> (..., b / ghost_batch_size, ghost_batch_size, ...)
+        shape = x.shape
+        x = x.reshape(tuple(shape[i] for i in range(batch_axis)) +
+                      (shape[batch_axis] // ghost_batch_size, ghost_batch_size) +
+                      tuple(shape[i] for i in range(batch_axis + 1, x.ndim)))
+        axis = [i + 1 if i >= batch_axis else i for i in axis]
+        ghost_pattern = lambda ndim: tuple(range(batch_axis)) + ('x',) + \
+                tuple(range(batch_axis, ndim))
+        if betas == 0 :
+            pass
+        else :
+            betas = betas.dimshuffle(*ghost_pattern(betas.ndim))
+        gammas = gammas.dimshuffle(*ghost_pattern(gammas.ndim))
+
+    mean = x.mean(axis=axis, keepdims=True)
+    if not bn_mean_only :
+        var = T.mean(T.sqr(x - mean), axis=axis, keepdims=True)
+    else :
+        var = theano.tensor.ones_like(mean)
 
     var_corrected = var + 1e-6
     y = theano.tensor.nnet.bn.batch_normalization(
-        inputs=x, gamma=gammas.dimshuffle(pattern), beta=betas,
+        inputs=x, gamma=gammas, beta=betas,
         mean=mean,
         std=theano.tensor.sqrt(var_corrected),
         mode="low_mem")
+
+    if ghost_batch_size is not None:
+        y = y.reshape(shape, ndim=y.ndim - 1)
+        mean = mean.mean(axis=batch_axis)
+        var = var.mean(axis=batch_axis)
     return y, mean, var
+
+
+
+if __name__ == '__main__':
+    import numpy as np
+
+    # ghost batch norm on bc, each virtual batch normalized over its own examples
+    x = T.fmatrix('x')
+    npx = np.random.random((8,4)).astype(np.float32)
+    betas = theano.shared(np.zeros(4, dtype=np.float32))
+    gammas = theano.shared(np.ones(4, dtype=np.float32))
+    y, mean, var = batch_norm(x, betas, gammas, ghost_batch_size=2)
+    out, m, v = theano.function([x], [y, mean, var])(npx)
+
+    ghosts = npx.reshape((4,2,4))
+    expected = (ghosts - ghosts.mean(axis=1, keepdims=True)) / \
+            np.sqrt(ghosts.var(axis=1, keepdims=True) + 1e-6)
+    assert np.allclose(out, expected.reshape((8,4)), atol=1e-4)
+    assert m.shape == v.shape == (1,4)
+    assert np.allclose(m, ghosts.mean(axis=1).mean(axis=0), atol=1e-6)
+    print "ghost batch norm on {} with virtual batches of 2: ok".format(npx.shape)
@@ -0,0 +1,107 @@
+import theano
+import theano.tensor as T
+from theano.tensor.signal.pool import pool_2d
+
+import utils
+from baselayers import AbsLayer
+
+# Parameter free downsampling. theano pools the last two axes of a tensor of any
+# ndim, so bc01 and tbc01 are both pooled as is without collapsing time and batch.
+
+
+class Pooling(AbsLayer):
+    """
+        mode := 'max', 'average_exc_pad' (padding not counted in the mean),
+        'average_inc_pad' or 'sum'
+        strides := default to pooling_size, non overlapping windows
+    """
+    def __init__(self, pooling_size, strides=None, padding=(0,0), mode='max', **kwargs):
+        super(Pooling, self).__init__(**kwargs)
+        assert mode in ['max', 'average_exc_pad', 'average_inc_pad', 'sum']
+        self.pooling_size = utils.parse_tuple(pooling_size, 2)
+        self.strides = self.pooling_size if strides is None else utils.parse_tuple(strides, 2)
+        self.padding = utils.parse_tuple(padding, 2)
+        self.mode = mode
+
+
+    def set_io_dims(self, tup):
+        self.input_dims = tup
+        feature_size = tuple(None if i is None else (i + 2 * p - k) // s + 1 for i, k, s, p in
+                             zip(tup[-2:], self.pooling_size, self.strides, self.padding))
+        self.output_dims = tup[:-2] + feature_size
+
+
+    def fprop(self, x, **kwargs):
+        return pool_2d(x, ws=self.pooling_size, stride=self.strides, pad=self.padding,
+                       ignore_border=True, mode=self.mode)
+
+
+
+class MaxPooling(Pooling):
+    def __init__(self, pooling_size, **kwargs):
+        super(MaxPooling, self).__init__(pooling_size, mode='max', **kwargs)
+
+
+
+class AveragePooling(Pooling):
+    def __init__(self, pooling_size, include_padding=False, **kwargs):
+        mode = 'average_inc_pad' if include_padding else 'average_exc_pad'
+        super(AveragePooling, self).__init__(pooling_size, mode=mode, **kwargs)
+
+
+
+class GlobalPooling(AbsLayer):
+    """
+        Pool the whole feature map to 1x1. The average is a gemv of the flattened
+        feature maps, (..., h * w) . ones(h * w) / (h * w), which is faster than the
+        elementwise mean reduction of extras.SpatialMean.
+    """
+    def __init__(self, mode='average', **kwargs):
+        super(GlobalPooling, self).__init__(**kwargs)
+        assert mode in ['average', 'max']
+        self.mode = mode
+
+
+    def set_io_dims(self, tup):
+        self.input_dims = tup
+        self.output_dims = tup[:-2] + (1,1)
+
+
+    def fprop(self, x, **kwargs):
+        if self.mode == 'max':
+            return T.max(x, axis=(x.ndim-2, x.ndim-1), keepdims=True)
+        # the spatial axes are contiguous, flattening them is a view
+        n_maps = T.prod(x.shape[:-2])
+        n = x.shape[-2] * x.shape[-1]
+        w = T.alloc(T.cast(1., x.dtype), n) / T.cast(n, x.dtype)
+        out = T.dot(x.reshape((n_maps, n), ndim=2), w)
+        return out.reshape(tuple(x.shape[i] for i in range(x.ndim-2)) + (1,1), ndim=x.ndim)
+
+
+
+if __name__ == '__main__':
+    import numpy as np
+    from extras import SpatialMean
+
+    x = T.ftensor4('x')
+    npx = np.random.random((64,256,16,16)).astype(np.float32)
+
+    pool = MaxPooling(2)
+    pool.set_io_dims(npx.shape[1:])
+    f = theano.function([x], pool.fprop(x))
+    assert f(npx).shape[1:] == pool.output_dims
+    print "max pooling 2x2 {}: {:.2f}ms".format(
+        npx.shape, utils.time_function(f, [npx]) * 1e3)
+
+    f_old = theano.function([x], SpatialMean().fprop(x))
+    f_new = theano.function([x], GlobalPooling().fprop(x))
+    assert np.allclose(f_old(npx), f_new(npx), atol=1e-5)
+    for i in range(3):
+        print "global average {}: SpatialMean {:.2f}ms, GlobalPooling {:.2f}ms".format(
+            npx.shape, utils.time_function(f_old, [npx], n_runs=30) * 1e3,
+            utils.time_function(f_new, [npx], n_runs=30) * 1e3)
+
+    x5 = T.TensorType('float32', (False,)*5)('x5')
+    npx5 = np.random.random((3,4,8,5,5)).astype(np.float32)
+    out = theano.function([x5], GlobalPooling().fprop(x5))(npx5)
+    assert np.allclose(out, npx5.mean(axis=(3,4), keepdims=True), atol=1e-5)
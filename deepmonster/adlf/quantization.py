@@ -0,0 +1,249 @@
+import time
+import numpy as np
+import theano
+import theano.tensor as T
+
+import utils
+from baselayers import RecurrentLayer
+from convolution import ConvLayer
+from scanlayers import ScanLayer
+from simple import FullyConnectedLayer
+
+# Post-training int8 quantization for FullyConnectedLayer and ConvLayer (and their
+# subclasses). The weights are stored as int8 with one float32 scale per output
+# channel, the input of each layer is quantized on a per tensor scale found by
+# calibration on a fuel stream. Theano has no int8 gemm, so the int8 values are
+# cast to float32 inside the graph and the dot / conv accumulates in float32. The
+# scales are applied once on the output of the dot / conv.
+#
+# Typical usage :
+#     y = ff.fprop(x) ; f_float = theano.function([x], y)
+#     report = quantize_feedforward(ff, x, calibration_stream)
+#     yq = ff.fprop(x) ; f_quant = theano.function([x], yq)
+#     report.update(compare_quantization(f_float, f_quant, valid_stream))
+
+
+def quantize_tensor(w, axis, nbits=8):
+    """
+        Symmetric per-channel quantization of the numpy array w.
+        axis is the output channel axis, one scale is kept for each slice along it.
+        Returns the int8 array and the float32 scales.
+    """
+    qmax = 2 ** (nbits - 1) - 1
+    axes = tuple(i for i in range(w.ndim) if i != axis)
+    scale = (np.abs(w).max(axis=axes) / qmax).astype(np.float32)
+    # a dead channel is all zeros, any scale will do
+    scale[scale == 0.] = 1.
+
+    shape = [1] * w.ndim
+    shape[axis] = -1
+    q = np.clip(np.round(w / scale.reshape(shape)), -qmax, qmax)
+    return q.astype(np.int8), scale
+
+
+def quantizable_layers(feedforward):
+    """
+        Return a list of (index, layer) of the layers that can be quantized in this
+        Feedforward. index is the position in the chain, its input is activations_list[index].
+        For a RecurrentLayer, only the upwardlayer is quantized. A layer without a W
+        in its param_dict (ex.: factorized by compression) is left in float32.
+    """
+    layers = []
+    for i, layer in enumerate(feedforward.layers):
+        if isinstance(layer, RecurrentLayer):
+            layer = layer.upwardlayer
+        if not isinstance(layer, (FullyConnectedLayer, ConvLayer)) or \
+           isinstance(layer, ScanLayer):
+            continue
+        if 'W' not in layer.param_dict:
+            # ex.: a LowRankFullyConnectedLayer from compression, W is factorized
+            print "WARNING: layer {} has no W to quantize, skipping".format(layer.prefix)
+            continue
+        if getattr(layer, 'W_int8', None) is not None:
+            print "WARNING: layer {} is already quantized, skipping".format(layer.prefix)
+            continue
+        layers += [(i, layer)]
+    return layers
+
+
+def calibrate(feedforward, x, stream, n_batches=None, **fprop_kwargs):
+    """
+        Propagate the stream through the feedforward and collect the max absolute value
+        seen at the input of every quantizable layer. The first source of the stream
+        is fed to x.
+    """
+    layers = quantizable_layers(feedforward)
+    outputs = feedforward.fprop(x, output_id='all', **fprop_kwargs)
+    inputs = [x] + outputs[:-1]
+    f = theano.function([x], [abs(inputs[i]).max() for i, _ in layers],
+                        on_unused_input='ignore')
+
+    ranges = np.zeros(len(layers), dtype=np.float32)
+    for j, batch in enumerate(stream.get_epoch_iterator()):
+        if n_batches is not None and j >= n_batches:
+            break
+        ranges = np.maximum(ranges, f(batch[0]))
+
+    return [(layer, r) for (_, layer), r in zip(layers, ranges)]
+
+
+def quantize_layer(layer, input_range=None):
+    """
+        Convert layer.W to int8 with per output channel scales. If input_range is given,
+        the input of the layer is also quantized to 8 bits on a scale of input_range / 127.
+
+        The float32 W is removed from layer.params and replaced by W_int8 and W_scale.
+    """
+    W = layer.W
+    w = W.get_value() if hasattr(W, 'get_value') else W.eval()
+    # FullyConnectedLayer.W is (in, out), ConvLayer.W (and DeConvLayer.W) is (out, in, 0, 1)
+    axis = 0 if isinstance(layer, ConvLayer) else 1
+    q, scale = quantize_tensor(w, axis)
+
+    layer.W_int8 = theano.shared(q, name='%s_'%layer.prefix+'W_int8')
+    layer.W_scale = theano.shared(scale, name='%s_'%layer.prefix+'W_scale')
+    layer.params = [p for p in layer.params if p.name != '%s_'%layer.prefix+'W'] + \
+            [layer.W_int8, layer.W_scale]
+    layer.W = T.cast(layer.W_int8, 'float32')
+
+    if input_range is not None and input_range > 0:
+        layer.input_scale = np.float32(input_range / 127.)
+    else:
+        layer.input_scale = None
+
+    # shadow the class apply on this instance, fprop will pick this one
+    float_apply = layer.apply
+    def apply(x, **kwargs):
+        scale = layer.W_scale
+        if layer.input_scale is not None:
+            x = T.clip(T.round(x / layer.input_scale), -127, 127)
+            scale = scale * layer.input_scale
+        out = float_apply(x, **utils.accepted_kwargs(float_apply, kwargs))
+        # same channel axis logic as Layer.apply_bias
+        pattern = ['x'] * out.ndim
+        pattern[2 if out.ndim in [3, 5] else 1] = 0
+        return out * scale.dimshuffle(*pattern)
+    layer.apply = apply
+
+    return w.nbytes, q.nbytes + scale.nbytes
+
+
+def quantize_feedforward(feedforward, x, stream=None, n_batches=None,
+                         quantize_inputs=True, **fprop_kwargs):
+    """
+        Calibrate on stream and quantize every FullyConnectedLayer / ConvLayer of the
+        feedforward in place. Any graph built after this call will use the int8 path,
+        so build the float32 graph before if you want to compare.
+
+        Returns a dict with the weight memory before and after.
+    """
+    if quantize_inputs:
+        if stream is None:
+            raise ValueError("Quantizing inputs needs a stream to calibrate on")
+        to_quantize = calibrate(feedforward, x, stream, n_batches, **fprop_kwargs)
+    else:
+        to_quantize = [(layer, None) for _, layer in quantizable_layers(feedforward)]
+
+    float_bytes = 0 ; int8_bytes = 0
+    for layer, input_range in to_quantize:
+        fb, qb = quantize_layer(layer, input_range)
+        float_bytes += fb
+        int8_bytes += qb
+
+    print "Quantized {} layers of {}, weights went from {:.2f}MB to {:.2f}MB".format(
+        len(to_quantize), feedforward.prefix, float_bytes / 2.**20, int8_bytes / 2.**20)
+
+    return {'quantized_layers' : len(to_quantize),
+            'float32_bytes' : float_bytes,
+            'int8_bytes' : int8_bytes}
+
+
+def compare_quantization(float_fn, quant_fn, stream, n_batches=None):
+    """
+        Run both compiled functions on the stream (first source is the input) and report
+        the output error, the throughput and, if the stream has targets as its second
+        source, the accuracy drop of the argmax of the outputs.
+    """
+    t_float = 0. ; t_quant = 0.
+    n_examples = 0
+    max_err = 0. ; sum_err = 0. ; n_outputs = 0
+    float_hits = 0 ; quant_hits = 0
+    has_targets = False
+
+    for j, batch in enumerate(stream.get_epoch_iterator()):
+        if n_batches is not None and j >= n_batches:
+            break
+        t0 = time.time()
+        yf = float_fn(batch[0])
+        t1 = time.time()
+        yq = quant_fn(batch[0])
+        t_quant += time.time() - t1
+        t_float += t1 - t0
+
+        # theano.function([x], [y]) returns a list
+        if isinstance(yf, list):
+            yf = yf[0] ; yq = yq[0]
+        err = np.abs(yf - yq)
+        max_err = max(max_err, err.max())
+        sum_err += err.sum()
+        n_outputs += err.size
+        n_examples += batch[0].shape[0]
+
+        if len(batch) > 1:
+            has_targets = True
+            targets = batch[1].flatten()
+            float_hits += (yf.reshape((yf.shape[0], -1)).argmax(axis=1) == targets).sum()
+            quant_hits += (yq.reshape((yq.shape[0], -1)).argmax(axis=1) == targets).sum()
+
+    report = {
+        'max_abs_error' : max_err,
+        'mean_abs_error' : sum_err / max(n_outputs, 1),
+        'float32_examples_per_sec' : n_examples / max(t_float, 1e-9),
+        'int8_examples_per_sec' : n_examples / max(t_quant, 1e-9),
+    }
+    print "Output error: max {:.5f}, mean {:.5f}".format(
+        report['max_abs_error'], report['mean_abs_error'])
+    print "Throughput: float32 {:.1f} ex/s, int8 {:.1f} ex/s".format(
+        report['float32_examples_per_sec'], report['int8_examples_per_sec'])
+
+    if has_targets:
+        report['float32_accuracy'] = float_hits / float(n_examples)
+        report['int8_accuracy'] = quant_hits / float(n_examples)
+        report['accuracy_drop'] = report['float32_accuracy'] - report['int8_accuracy']
+        print "Accuracy: float32 {:.4f}, int8 {:.4f}, drop {:.4f}".format(
+            report['float32_accuracy'], report['int8_accuracy'], report['accuracy_drop'])
+
+    return report
+
+
+
+if __name__ == '__main__':
+    from activations import Rectifier, Softmax
+    from extras import Reshape
+    from network import Feedforward
+
+    class ToyStream(object):
+        def __init__(self, n, shape):
+            self.data = [np.random.random(shape).astype(np.float32) for i in range(n)]
+        def get_epoch_iterator(self):
+            return iter([(d,) for d in self.data])
+
+    config = {
+        'use_bias' : True,
+        'activation' : Rectifier(),
+    }
+    layers = [
+        ConvLayer(3, 64, num_channels=3, image_size=(32,32), padding='half'),
+        ConvLayer(3, 64, strides=(2,2), padding='half'),
+        ConvLayer(3, 128, strides=(2,2), padding='half'),
+        Reshape((None, 128*8*8)),
+        FullyConnectedLayer(input_dims=128*8*8, output_dims=10, activation=Softmax()),
+    ]
+    ff = Feedforward(layers, 'qnet', **config)
+    ff.initialize()
+
+    x = T.ftensor4('x')
+    f_float = theano.function([x], ff.fprop(x))
+    report = quantize_feedforward(ff, x, ToyStream(10, (64,3,32,32)))
+    f_quant = theano.function([x], ff.fprop(x))
+    report.update(compare_quantization(f_float, f_quant, ToyStream(20, (64,3,32,32))))
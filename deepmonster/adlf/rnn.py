@@ -1,5 +1,3 @@
-import inspect
-
 import utils
 from baselayers import RecurrentLayer
 from convolution import ConvLayer, DeConvLayer
@@ -22,9 +20,11 @@ class TypicalReccurentLayer(RecurrentLayer):
     """
     def __init__(self, *args, **kwargs):
         mode = kwargs.pop('mode', 'auto')
-        super(TypicalReccurentLayer, self).__init__(*args, mode=mode)
+        time_chunk = kwargs.pop('time_chunk', None)
+        super(TypicalReccurentLayer, self).__init__(*args, mode=mode, time_chunk=time_chunk)
         self.upwardlayer.use_bias = False
         self.upwardlayer.batch_norm = False
+        self.upwardlayer.layer_norm = False
         self.upwardlayer.activation = None
 
 
@@ -36,7 +36,7 @@ class TypicalReccurentLayer(RecurrentLayer):
         """
         if not hasattr(upwardlayer, '__init__'):
             return kwargs
-        kwargs_upwardlayer = inspect.getargspec(upwardlayer.__init__)
+        kwargs_upwardlayer = utils.getargspec(upwardlayer.__init__)
         for arg in kwargs_upwardlayer.args:
             if kwargs.has_key(arg):
                 kwargs.pop(arg)
@@ -50,7 +50,8 @@ class LSTM(TypicalReccurentLayer):
 
         REMINDER: Take care with those * 4
     """
-    def __init__(self, output_dims, input_dims=None, upward=None, time=None, **kwargs):
+    def __init__(self, output_dims, input_dims=None, upward=None, time=None,
+                 mode='auto', time_chunk=None, **kwargs):
         output_dims = utils.parse_tuple(output_dims)
 
         if upward is None:
@@ -62,7 +63,7 @@ class LSTM(TypicalReccurentLayer):
         if time is None:
             time = ScanLSTM(output_dims=output_dims, input_dims=output_dims, **kwargs)
 
-        super(LSTM, self).__init__(upward, time, **kwargs)
+        super(LSTM, self).__init__(upward, time, mode=mode, time_chunk=time_chunk, **kwargs)
 
 
 
@@ -74,11 +75,14 @@ class ConvLSTM(TypicalReccurentLayer):
     """
     def __init__(self, filter_size, num_filters,
                  time_filter_size=None, time_num_filters=None,
-                 convupward=None, convtime=None, **kwargs):
+                 time_dilation=None, convupward=None, convtime=None, mode='auto',
+                 time_chunk=None, batch_size=None, **kwargs):
         if time_filter_size is None:
             time_filter_size = utils.parse_tuple(filter_size, 2)
         if time_num_filters is None:
             time_num_filters = num_filters
+        if time_dilation is None:
+            time_dilation = kwargs.get('dilation', (1,1))
 
         if convupward is None or convupward is 'conv':
             convupward = ConvLayer(filter_size, num_filters*4, **kwargs)
@@ -87,10 +91,13 @@ class ConvLSTM(TypicalReccurentLayer):
 
         kwargs = self.popkwargs(convupward, kwargs)
         if convtime is None or convtime is 'conv':
-            convtime = ScanConvLSTM(time_filter_size, num_filters,
-                                    num_channels=num_filters, **kwargs)
+            # the upward conv sees time and batch collapsed, only the scan
+            # convolutions have a fixed batch size
+            convtime = ScanConvLSTM(time_filter_size, num_filters, num_channels=num_filters,
+                                    batch_size=batch_size, dilation=time_dilation, **kwargs)
 
-        super(ConvLSTM, self).__init__(convupward, convtime, **kwargs)
+        super(ConvLSTM, self).__init__(convupward, convtime, mode=mode,
+                                       time_chunk=time_chunk, **kwargs)
 
 
 
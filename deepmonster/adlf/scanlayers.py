@@ -1,8 +1,8 @@
-import inspect
 import numpy as np
 import theano
 import theano.tensor as T
 
+import utils
 from baselayers import Layer
 from convolution import ConvLayer
 from simple import FullyConnectedLayer
@@ -29,7 +29,7 @@ class ScanLayer(Layer):
             The step functions takes as non seq positional arguments (such as the weight
             matrix) and kwargs (such as batch_norm parameters)
         """
-        step_arg_list = inspect.getargspec(self.step).args
+        step_arg_list = utils.getargspec(self.step).args
         param_names = [x for x in self.param_dict.keys()]
 
         slice_len = len(param_names)
@@ -180,12 +180,12 @@ class ScanLSTM(ScanLayer, FullyConnectedLayer):
         self.param_dict = dict_of_init
 
 
-    def initialize(self):
-        super(ScanLSTM, self).initialize()
-        ### Forget biais init
-        forget_biais = self.xh_betas.get_value()
-        forget_biais[self.output_dims[0]:2*self.output_dims[0]] = 1.
-        self.xh_betas.set_value(forget_biais)
+    def get_param_value(self, key):
+        value = super(ScanLSTM, self).get_param_value(key)
+        if key == 'xh_betas':
+            ### Forget biais init
+            value[self.output_dims[0]:2*self.output_dims[0]] = 1.
+        return value
 
 
     def op(self, h, U):
@@ -216,9 +216,9 @@ class ScanLSTM(ScanLayer, FullyConnectedLayer):
 
         preact = self.op(h_, U)
 
-        if self.batch_norm :
-            x_normal = self.bn(x_, xh_betas, x_gammas, '_x', deterministic)
-            h_normal = self.bn(preact, 0, h_gammas, '_h', deterministic)
+        if self.batch_norm or self.layer_norm :
+            x_normal = self.normalize(x_, xh_betas, x_gammas, '_x', deterministic)
+            h_normal = self.normalize(preact, 0, h_gammas, '_h', deterministic)
             preact = x_normal + h_normal
         else :
             xh_betas = xh_betas.dimshuffle(*('x',0) + ('x',) * (preact.ndim-2))
@@ -234,8 +234,8 @@ class ScanLSTM(ScanLayer, FullyConnectedLayer):
 
         c = f * c_ + delta_c_
 
-        if self.batch_norm :
-            c_normal = self.bn(c, c_betas, c_gammas, '_c', deterministic)
+        if self.batch_norm or self.layer_norm :
+            c_normal = self.normalize(c, c_betas, c_gammas, '_c', deterministic)
             h = o * T.tanh(c_normal)
         else :
             h = o * T.tanh(c)
@@ -289,9 +289,16 @@ class ScanConvLSTM(ScanLSTM, ConvLayer):
 
     def op(self, h, U):
         if self.filter_size == (1,1) :
-            preact = T.dot(h.flatten(2), U.flatten(2).dimshuffle(1,0))[:,:,None,None]
+            U = U.flatten(2).dimshuffle(1,0)
+            preact = utils.apply_on_channels(h, lambda y: T.dot(y, U),
+                                             tuple(self.feature_size) == (1,1))
         else :
-            preact = T.nnet.conv2d(h, U, border_mode='half')
+            preact = T.nnet.conv2d(h, U, border_mode='half',
+                                   input_shape=(self.batch_size, self.num_filters) +
+                                   tuple(self.feature_size),
+                                   filter_shape=(4*self.num_filters, self.num_filters) +
+                                   self.filter_size,
+                                   filter_dilation=self.dilation)
         return preact
 
 
@@ -313,7 +320,7 @@ _
             mask_c = args[1]
             # arglist is unaware of the mask as it is not in the
             # step function signature (thats why the +2)
-            arglist = inspect.getargspec(step).args
+            arglist = utils.getargspec(step).args
             h_ = args[arglist.index('h_')+2]
             c_ = args[arglist.index('c_')+2]
             zoneout_flag = args[arglist.index('zoneout_flag')+2]
@@ -1,7 +1,10 @@
 import numpy as np
 import theano
 import theano.tensor as T
-from baselayers import Layer
+from theano import sparse
+
+import utils
+from baselayers import Layer, RandomLayer
 
 
 class FullyConnectedLayer(Layer) :
@@ -9,7 +12,7 @@ class FullyConnectedLayer(Layer) :
         dict_of_init = {
             'W' : [(self.input_dims[0],self.output_dims[0],), 'norm', 0.1]}
 
-        if self.use_bias or self.batch_norm:
+        if self.use_bias or self.batch_norm or self.layer_norm:
             dict_of_init.update({
             'betas' : [self.output_dims[0], 'zeros'],
             })
@@ -18,24 +21,40 @@ class FullyConnectedLayer(Layer) :
 
 
     def apply(self, x):
-        if x.ndim == 4:
-            # for a bc01 tensor, it will flatten 01 and do a dot
-            y = x.transpose(0,2,3,1)
-        elif x.ndim == 2:
-            y = x
-        elif x.ndim == 3:
-            # tbc, collapse t and b
-            y = x.reshape((x.shape[0]*x.shape[1],x.shape[2]))
-        else:
-            raise ValueError("Where are you going with these dimensions in a fullyconnected?")
+        # bc, tbc, bc01 or tbc01, the dot is done on the c axis
+        flat_spatial = tuple(self.input_dims[1:]) == (1,1)
+        return utils.apply_on_channels(x, self.dot, flat_spatial)
+
+
+    def dot(self, y):
+        # W can be swapped for a sparse shared (see compression.MagnitudePruning)
+        if isinstance(self.W.type, sparse.SparseType):
+            return sparse.dot(y, self.W)
+        return T.dot(y, self.W)
+
+
+
+class LowRankFullyConnectedLayer(FullyConnectedLayer):
+    """
+        FullyConnectedLayer where W is stored factorized as W_U (in, rank) . W_V (rank, out).
+        The application is two dots, which is cheaper than one as long as
+        rank * (in + out) < in * out.
+    """
+    def __init__(self, rank, **kwargs):
+        super(LowRankFullyConnectedLayer, self).__init__(**kwargs)
+        self.rank = rank
 
-        out = T.dot(y, self.W)
-        if x.ndim == 4:
-            out = out.transpose(0,3,1,2)
-        elif x.ndim == 3:
-            out = out.reshape((x.shape[0],x.shape[1],out.shape[1]))
 
-        return out
+    def param_dict_initialization(self):
+        super(LowRankFullyConnectedLayer, self).param_dict_initialization()
+        self.param_dict.pop('W')
+        self.param_dict.update({
+            'W_U' : [(self.input_dims[0],self.rank,), 'norm', 0.1],
+            'W_V' : [(self.rank,self.output_dims[0],), 'norm', 1. / np.sqrt(self.rank)]})
+
+
+    def dot(self, y):
+        return T.dot(T.dot(y, self.W_U), self.W_V)
 
 
 
@@ -49,18 +68,30 @@ class FullyConnectedOnLastTime(FullyConnectedLayer):
 
 
 
-class NoiseConditionalLayer(FullyConnectedLayer):
+class NoiseConditionalLayer(FullyConnectedLayer, RandomLayer):
     """
         This class takes x and apply a linear transform on it to expend it
-        into mu, sigma and return mu + sigma * noise
+        into mu, logsigma and return mu + exp(logsigma) * noise
+
+        n_samples := number of noise draws per input. mu and logsigma are computed
+        once and broadcasted on a new sample axis which is then folded in the batch
+        axis, sample major. The layers above see a batch of n_samples * b.
+        In deterministic mode, mu is returned (repeated n_samples times).
     """
-    def __init__(self, noise_type='gaussian', **kwargs):
+    def __init__(self, noise_type='gaussian', n_samples=1, **kwargs):
         assert noise_type in ['gaussian', 'uniform']
         super(NoiseConditionalLayer, self).__init__(**kwargs)
         self.noise_type = noise_type
+        self.n_samples = n_samples
         self.activation = None
 
 
+    def set_attributes(self, dict_of_hyperparam):
+        # mu and logsigma are linear, the activation of the chain is not for this layer
+        super(NoiseConditionalLayer, self).set_attributes(
+            dict((k, v) for k, v in dict_of_hyperparam.iteritems() if k != 'activation'))
+
+
     def param_dict_initialization(self):
         dict_of_init = {
             'W' : [(self.input_dims[0],self.output_dims[0] * 2,), 'norm', 0.1]}
@@ -73,34 +104,66 @@ class NoiseConditionalLayer(FullyConnectedLayer):
 
 
     def fprop(self, x, **kwargs):
-        mulogsigma = super(NoiseConditionalLayer, self).fprop(x, **kwargs)
         det = kwargs.get('deterministic', False)
+        mulogsigma = super(NoiseConditionalLayer, self).fprop(x)
 
+        # the channel axis is 1 for bc / bc01 and 2 for tbc / tbc01, batch is right before
+        axis = 2 if x.ndim in [3, 5] else 1
         slice_dim = self.output_dims[0]
-        if x.ndim in [2, 4]:
-            mu = mulogsigma[:,:slice_dim]
-            logsigma = mulogsigma[:,slice_dim:]
-        elif x.ndim in [3, 5]:
-            mu = mulogsigma[:,:,:slice_dim]
-            logsigma = mulogsigma[:,:,slice_dim:]
+        mu = mulogsigma[(slice(None),) * axis + (slice(None, slice_dim),)]
+        logsigma = mulogsigma[(slice(None),) * axis + (slice(slice_dim, None),)]
+
+        # the sample axis goes right before the batch axis
+        pattern = range(mu.ndim)
+        pattern.insert(axis - 1, 'x')
+        shape = [mu.shape[i] for i in range(mu.ndim)]
+        shape.insert(axis - 1, self.n_samples)
 
         if det:
-            epsilon = 1.
+            noised_x = T.alloc(mu.dimshuffle(*pattern), *shape)
         else:
             if self.noise_type == 'gaussian':
-                epsilon = self.rng_theano.normal(size=mu.shape)
+                epsilon = self.rng_theano.normal(size=tuple(shape))
             elif self.noise_type == 'uniform':
-                epsilon = self.rng_theano.uniform(size=mu.shape)
+                epsilon = self.rng_theano.uniform(size=tuple(shape))
+            sigma = T.exp(logsigma)
+            noised_x = mu.dimshuffle(*pattern) + sigma.dimshuffle(*pattern) * epsilon
 
-        noised_x = mu + sigma * epsilon
-
-        return noised_x
+        # fold the samples in the batch
+        folded_shape = shape[:axis-1] + [self.n_samples * shape[axis]] + shape[axis+1:]
+        return noised_x.reshape(tuple(folded_shape), ndim=mu.ndim)
 
 
 
 if __name__ == '__main__' :
     from activations import Rectifier
     from convolution import *
+    from network import Feedforward
+
+    # K draws of a NoiseConditionalLayer inside a chain with an activation
+    K = 4
+    x = T.fmatrix('x')
+    npx = np.random.random((5, 6)).astype(np.float32)
+    for noise_type in ['gaussian', 'uniform']:
+        ff = Feedforward([NoiseConditionalLayer(input_dims=6, output_dims=3, n_samples=K,
+                                                noise_type=noise_type)],
+                         'ncl', activation=Rectifier(), use_bias=True)
+        ff.initialize()
+        assert ff.layers[0].activation is None
+        # a large bias on logsigma, sigma is far from 1 only if it is not rectified
+        ff.layers[0].betas.set_value(np.array([0,0,0,-5,-5,-5], dtype=np.float32))
+        f = theano.function([x], ff.fprop(x))
+        f_det = theano.function([x], ff.fprop(x, deterministic=True))
+        out, out_det = f(npx), f_det(npx)
+        assert out.shape == out_det.shape == (K * 5, 3)
+        # sample major, every draw of deterministic is mu
+        assert np.allclose(out_det[:5], out_det[5:10])
+        # the draws differ, by a small sigma
+        assert not np.allclose(out[:5], out[5:10])
+        assert np.abs(out - out_det).max() < 0.1
+        print "NoiseConditionalLayer {}: {} draws of {}, ok".format(
+            noise_type, K, npx.shape)
+
     fl = FullyConnectedLayer(input_size=3,output_size=97,
                              prefix='fl',weight_norm=False,
                              batch_norm=True,gamma_scale=0.1,
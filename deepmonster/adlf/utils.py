@@ -1,5 +1,5 @@
 import numpy as np
-import inspect, os, re, shutil, sys
+import inspect, os, re, shutil, sys, time, weakref
 
 import theano
 import theano.tensor as T
@@ -10,6 +10,65 @@ def getftensor5():
     return T.TensorType('float32', (False,)*5)
 
 
+def apply_on_channels(x, f, flat_spatial=False):
+    """
+        Apply f, a function of a (n, c_in) matrix to a (n, c_out) matrix such as a dot,
+        on the channel axis of x as one gemm over a (batch*time*spatial, c_in) view.
+        The channel axis is 1 for bc / bc01 and 2 for tbc / tbc01.
+
+        For bc and tbc the channels are already the last axis and collapsing the others
+        is a free reshape. For bc01 and tbc01, if flat_spatial says the image is 1x1,
+        it is a free reshape too, else the channels have to be moved last.
+    """
+    if x.ndim == 2:
+        return f(x)
+    elif x.ndim == 3:
+        out = f(x.reshape((x.shape[0]*x.shape[1],x.shape[2])))
+        return out.reshape((x.shape[0],x.shape[1],out.shape[1]))
+    elif x.ndim not in [4, 5]:
+        raise ValueError("Where are you going with these dimensions on channels?")
+
+    # leading axes are b or t,b
+    lead = tuple(x.shape[i] for i in range(x.ndim-3))
+    if flat_spatial:
+        out = f(x.reshape((T.prod(x.shape[:-3]),x.shape[-3])))
+        return out.reshape(lead + (out.shape[1],1,1))
+
+    pattern = tuple(range(x.ndim-3)) + (x.ndim-2, x.ndim-1, x.ndim-3)
+    y = x.dimshuffle(*pattern)
+    out = f(y.reshape((T.prod(y.shape[:-1]),y.shape[-1])))
+    out = out.reshape(lead + (x.shape[-2],x.shape[-1],out.shape[1]))
+    pattern = tuple(range(x.ndim-3)) + (x.ndim-1, x.ndim-3, x.ndim-2)
+    return out.dimshuffle(*pattern)
+
+
+def apply_on_collapsed_time(f, x, time_chunk=None):
+    """
+        Apply f, a function of a 4D bc01 tensor, on the 5D tbc01 x by collapsing its time
+        and batch axes together.
+
+        With time_chunk, the collapsed batch is given to f time_chunk time steps at a time
+        in a scan, so the workspace and activations of f are bounded by time_chunk * b
+        instead of t * b. The time axis is zero padded up to a multiple of time_chunk,
+        so this is exact only for an f without batch statistics.
+    """
+    if time_chunk is None:
+        y = x.reshape((x.shape[0]*x.shape[1],x.shape[2],x.shape[3],x.shape[4]))
+        out = f(y)
+        return out.reshape((x.shape[0],x.shape[1],out.shape[1],out.shape[2],out.shape[3]))
+
+    t = x.shape[0]
+    n_chunks = (t + time_chunk - 1) // time_chunk
+    padding = T.zeros((n_chunks*time_chunk-t,x.shape[1],x.shape[2],x.shape[3],x.shape[4]),
+                      dtype=x.dtype)
+    y = T.concatenate([x, padding], axis=0)
+    y = y.reshape((n_chunks,time_chunk*x.shape[1],x.shape[2],x.shape[3],x.shape[4]))
+
+    out, _ = theano.scan(f, sequences=[y])
+    out = out.reshape((n_chunks*time_chunk,x.shape[1],out.shape[2],out.shape[3],out.shape[4]))
+    return out[:t]
+
+
 def infer_odim_conv(i, k, s):
     return (i-k) // s + 1
 
@@ -18,18 +77,86 @@ def infer_odim_convtrans(i, k, s) :
     return s*(i-1) + k
 
 
+def time_function(f, inputs, n_runs=10):
+    """
+        Average time in seconds of a call to f(*inputs). The first call
+        is not timed so thunks and caches are warm.
+    """
+    f(*inputs)
+    t0 = time.time()
+    for i in range(n_runs):
+        f(*inputs)
+    return (time.time() - t0) / n_runs
+
+
+def load_checkpoint(path):
+    """
+        Load a {param name : array} checkpoint without copying more than needed.
+            - a directory of name.npy files (see save_checkpoint) is memory mapped
+            - a .npz is read lazily, an array is only read when asked for
+            - a .pkl is the format of the blocks SaveExperiment extension
+    """
+    if os.path.isdir(path):
+        return {f[:-len('.npy')] : np.load(os.path.join(path, f), mmap_mode='r')
+                for f in os.listdir(path) if f.endswith('.npy')}
+    if path.endswith('.npz'):
+        return np.load(path)
+    import cPickle as pkl
+    with open(path, 'rb') as f:
+        return pkl.load(f)
+
+
+def save_checkpoint(params, path):
+    """
+        Save a list of shared variables as a directory of name.npy files
+        that load_checkpoint can memory map.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for param in params:
+        np.save(os.path.join(path, param.name + '.npy'), param.get_value())
+
+
 def log_sum_exp(x, axis=1):
     m = T.max(x, axis=axis)
     return m+T.log(T.sum(T.exp(x-m.dimshuffle(0,'x')), axis=axis))
 
 
 # http://kbyanc.blogspot.ca/2007/07/python-aggregating-function-arguments.html
+_argspec_cache = weakref.WeakKeyDictionary()
+
+def getargspec(f):
+    """
+        inspect.getargspec cached on the underlying function, so every instance
+        (bound method) of a class shares the same entry and it is computed once.
+    """
+    func = getattr(f, '__func__', f)
+    try:
+        return _argspec_cache[func]
+    except KeyError:
+        argspec = inspect.getargspec(func)
+        _argspec_cache[func] = argspec
+        return argspec
+
+
+def accepted_kwargs(f, kwargs):
+    """
+        The items of kwargs that f can take, all of them if f has a **kwargs
+    """
+    argspec = getargspec(f)
+    if argspec.keywords is not None:
+        return kwargs
+    return dict((k, v) for k, v in kwargs.iteritems() if k in argspec.args)
+
+
 def arguments(args_to_pop=None) :
     """Returns tuple containing dictionary of calling function's
     named arguments and a list of calling function's unnamed
     positional arguments.
     """
-    posname, kwname, args = inspect.getargvalues(inspect.stack()[1][0])[-3:]
+    # only the caller frame is needed, inspect.stack() would build the whole stack
+    # with the source context of every frame
+    posname, kwname, args = inspect.getargvalues(sys._getframe(1))[-3:]
     posargs = args.pop(posname, [])
     args.update(args.pop(kwname, []))
     if args_to_pop is not None :
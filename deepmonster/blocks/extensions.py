@@ -469,6 +469,26 @@ class AdjustSharedVariable(SimpleExtension):
 
 
 
+class PruneWeights(SimpleExtension):
+    """
+        Calls prune on a pruner (see adlf.compression.MagnitudePruning) with
+        the number of epochs done, or iterations done if every_n_batches is used.
+    """
+    def __init__(self, pruner, **kwargs):
+        kwargs.setdefault('after_epoch', True)
+        super(PruneWeights, self).__init__(**kwargs)
+        self.pruner = pruner
+
+
+    def do(self, which_callback, *args):
+        if which_callback == 'after_batch':
+            t = self.main_loop.status['iterations_done']
+        else:
+            t = self.main_loop.status['epochs_done']
+        self.pruner.prune(t)
+
+
+
 # borrowed from Kyle
 def prepare_png(X):
     def color_grid_vis(X):
@@ -0,0 +1,177 @@
+import cPickle as pkl
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+import theano
+from numpy.lib.format import open_memmap
+from fuel.datasets import IndexableDataset
+from fuel.schemes import SequentialScheme, ShuffledScheme
+from fuel.streams import DataStream
+
+
+class MemmapDataset(IndexableDataset):
+    """
+        IndexableDataset of memory mapped arrays. A request of consecutive indices
+        (ex.: from a SequentialScheme) is served as a slice, a view of the memmap
+        without any copy. Any other request is a fancy index, so a copy.
+    """
+    def get_data(self, state=None, request=None):
+        if state is not None or request is None:
+            raise ValueError
+        if isinstance(request, list) and len(request) > 0 and \
+           request[-1] - request[0] == len(request) - 1 and \
+           np.all(np.diff(request) == 1):
+            request = slice(request[0], request[-1] + 1)
+        return tuple(indexable[request] for indexable in self.indexables)
+
+
+def cache_stream(stream, num_examples, path):
+    """
+        Write every source of stream, an epoch of num_examples examples, to path_<source>.npy
+        and return them as a MemmapDataset. If these files are already there, they are
+        only loaded. A file only gets its final name once it is complete.
+    """
+    paths = OrderedDict((source, '{}_{}.npy'.format(path, source))
+                        for source in stream.sources)
+    if not all(os.path.isfile(p) for p in paths.values()):
+        print "Caching {} examples of {} to {}_*.npy".format(
+            num_examples, ', '.join(stream.sources), path)
+        memmaps = None
+        i = 0
+        for batch in stream.get_epoch_iterator():
+            if memmaps is None:
+                memmaps = [open_memmap(p + '.tmp', mode='w+', dtype=data.dtype,
+                                       shape=(num_examples,) + data.shape[1:])
+                           for p, data in zip(paths.values(), batch)]
+            for memmap, data in zip(memmaps, batch):
+                memmap[i:i+len(data)] = data
+            i += len(batch[0])
+        if i != num_examples:
+            raise ValueError("The stream gave {} examples instead of {}".format(i, num_examples))
+        for memmap, p in zip(memmaps, paths.values()):
+            memmap.flush()
+            os.rename(p + '.tmp', p)
+    else:
+        print "Using dataset cache {}_*.npy".format(path)
+
+    return MemmapDataset(OrderedDict((source, np.load(p, mmap_mode='r'))
+                                     for source, p in paths.iteritems()))
+
+
+
+class ActivationCache(object):
+    """
+        Cache on disk the output of the first input_id layers of a Feedforward, when these
+        are frozen and only the top is trained. The prefix is run once over a stream, its
+        output replaces the first source (the other sources, ex.: targets, are kept aligned)
+        and the cached stream feeds the rest of the chain with fprop(h, input_id=input_id).
+
+        The cache is keyed on a md5 of the prefix parameters, the files of a cache made
+        with other values of the prefix are deleted when it is rebuilt.
+
+        Typical usage :
+            cache = ActivationCache(ff, x, 3, '/tmp/cache', deterministic=True)
+            stream = cache.get_stream(train_stream, 'cifar10_train', batch_size=100)
+            h = T.ftensor4('h') ; y = ff.fprop(h, input_id=3)
+    """
+    def __init__(self, feedforward, x, input_id, cache_dir, **fprop_kwargs):
+        self.feedforward = feedforward
+        self.x = x
+        self.input_id = input_id
+        self.cache_dir = cache_dir
+        self.fprop_kwargs = fprop_kwargs
+
+
+    def prefix_hash(self):
+        md5 = hashlib.md5()
+        md5.update(str(self.input_id))
+        for layer in self.feedforward.layers[:self.input_id]:
+            for param in layer.params:
+                value = np.ascontiguousarray(param.get_value())
+                md5.update(param.name + str(value.shape) + str(value.dtype))
+                md5.update(value.data)
+        return md5.hexdigest()
+
+
+    def get_path(self, name):
+        return os.path.join(self.cache_dir, '{}_{}'.format(name, self.prefix_hash()))
+
+
+    def build(self, stream, path):
+        """
+            Run the prefix over the stream, every source is appended batch by batch to
+            a raw file and its dtype and shape are saved in meta.pkl.
+        """
+        print "Caching activations of the first {} layers of {} at {}".format(
+            self.input_id, self.feedforward.prefix, path)
+        h = self.feedforward.fprop(self.x, output_id=self.input_id, **self.fprop_kwargs)
+        f = theano.function([self.x], h, on_unused_input='ignore')
+
+        tmp = path + '_tmp'
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        sources = stream.sources
+        files = [open(os.path.join(tmp, source + '.dat'), 'wb') for source in sources]
+        meta = OrderedDict()
+        try:
+            for batch in stream.get_epoch_iterator():
+                batch = (f(batch[0]),) + tuple(batch[1:])
+                for source, fi, data in zip(sources, files, batch):
+                    data = np.ascontiguousarray(data)
+                    if source not in meta:
+                        meta[source] = [data.dtype.str, (0,) + data.shape[1:]]
+                    meta[source][1] = (meta[source][1][0] + data.shape[0],) + data.shape[1:]
+                    data.tofile(fi)
+        finally:
+            for fi in files:
+                fi.close()
+
+        with open(os.path.join(tmp, 'meta.pkl'), 'wb') as fi:
+            pkl.dump(meta, fi)
+        # only a complete cache gets the final name
+        os.rename(tmp, path)
+
+
+    def invalidate(self, name):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for d in os.listdir(self.cache_dir):
+            # name_<md5> or an unfinished name_<md5>_tmp
+            key = d[len(name)+1:].split('_')[0]
+            if d.startswith(name + '_') and len(key) == 32:
+                print "Removing stale activation cache", os.path.join(self.cache_dir, d)
+                shutil.rmtree(os.path.join(self.cache_dir, d))
+
+
+    def load(self, path):
+        with open(os.path.join(path, 'meta.pkl'), 'rb') as fi:
+            meta = pkl.load(fi)
+        return OrderedDict(
+            (source, np.memmap(os.path.join(path, source + '.dat'), dtype=np.dtype(dtype),
+                               mode='r', shape=shape))
+            for source, (dtype, shape) in meta.iteritems())
+
+
+    def get_stream(self, stream, name, batch_size, shuffle=False):
+        """
+            Return a stream of the cached activations of stream, build the cache first if
+            there is none for the current values of the prefix parameters. name identifies
+            the stream (dataset and split) in the cache_dir.
+        """
+        path = self.get_path(name)
+        if not os.path.isfile(os.path.join(path, 'meta.pkl')):
+            self.invalidate(name)
+            self.build(stream, path)
+        else:
+            print "Using activation cache", path
+
+        dataset = MemmapDataset(self.load(path))
+        Scheme = ShuffledScheme if shuffle else SequentialScheme
+        return DataStream(
+            dataset=dataset,
+            iteration_scheme=Scheme(dataset.num_examples, batch_size))
@@ -1,12 +1,26 @@
+import os
 import fuel.datasets
 from fuel.schemes import SequentialScheme, ShuffledScheme
 from fuel.streams import DataStream
 
-from transformers import InsertLabeledExamples, CopyBatch, Normalize_min1_1, Float32
+from cache import cache_stream
+from transformers import InsertLabeledExamples, CopyBatch, Normalize, Normalize_min1_1, \
+        Float32, Prefetch, MultiProcessTransformer
 
 
 def create_stream(dataset, batch_size, split=('train',), sources=('features',),
-                  normalization='01', ssl={}, load_in_memory=False, test=False):
+                  normalization='01', ssl={}, load_in_memory=False, test=False, prefetch=None,
+                  processes=None, cache_dir=None):
+    """
+        cache_dir := if not None, the normalized dataset is written once in cache_dir as
+        .npy files (one per source) and every epoch after that reads them memory mapped,
+        sequential batches are slices of the memmap without a copy. The files are keyed
+        by dataset, split, number of examples (the subset) and normalization.
+        processes := if not None, the normalization transformers run in a pool of that
+        many processes (see transformers.MultiProcessTransformer)
+        prefetch := if not None, the batches are produced in a background thread up to
+        prefetch batches in advance (see transformers.Prefetch)
+    """
     get_dataset = {
         'mnist' : get_mnist,
         'cifar10' : get_cifar10,
@@ -25,7 +39,20 @@ def create_stream(dataset, batch_size, split=('train',), sources=('features',),
     #TODO: more split
     assert len(split) == 1
 
+    name = dataset
     dataset = get_dataset[dataset](split, sources, load_in_memory)
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        path = os.path.join(cache_dir, '{}_{}_{}_{}'.format(
+            name, split[0], dataset.num_examples, normalization))
+        # every batch is copied in the memmap before the next one, one buffer is reused
+        stream = normalize_stream(
+            dataset, SequentialScheme(dataset.num_examples, 500), normalization, buffers=1)
+        dataset = cache_stream(stream, dataset.num_examples, path)
+        # it is already normalized
+        normalization = 'cached'
+
     if test:
         print "WARNING: Test flag at create_stream, loading stream with one batch_size"
         num_examples = batch_size
@@ -33,26 +60,48 @@ def create_stream(dataset, batch_size, split=('train',), sources=('features',),
         num_examples = (dataset.num_examples // batch_size) * batch_size
     scheme = Scheme[split[0]](num_examples, batch_size)
 
-    # this is a bit sloppy, cant assume that the default is a 01 normalization (so far it is)
+    if normalization == 'cached':
+        stream = DataStream(dataset=dataset, iteration_scheme=scheme)
+    else:
+        stream = normalize_stream(dataset, scheme, normalization)
+
+    if len(ssl) > 0:
+        raise NotImplementedError('didnt implement ssl stream fetcher')
+
+    if processes is not None and normalization == 'cached':
+        print "WARNING: the cached dataset has no transformer to run in processes"
+    elif processes is not None:
+        stream = MultiProcessTransformer(stream, processes=processes)
+    if prefetch is not None:
+        stream = Prefetch(stream, queue_size=prefetch)
+
+    return stream
+
+
+def normalize_stream(dataset, scheme, normalization, buffers=None):
+    """
+        buffers := see transformers.LookupNormalization, None is a new array per batch
+    """
+    # the uint8 features go through one table lookup, instead of the default_stream
+    # ScaleAndShift and Cast for 01
     if normalization is '01':
-        stream = DataStream.default_stream(
-            dataset=dataset,
-            iteration_scheme=scheme)
+        stream = Normalize(
+            DataStream(
+                dataset=dataset,
+                iteration_scheme=scheme),
+            normalization='01', buffers=buffers)
     elif normalization is '-1+1':
         stream = Normalize_min1_1(
             DataStream(
                 dataset=dataset,
-                iteration_scheme=scheme))
+                iteration_scheme=scheme),
+            buffers=buffers)
     else:
         stream = Float32(
             DataStream(
                 dataset=dataset,
-                iteration_scheme=scheme))
-
-
-    if len(ssl) > 0:
-        raise NotImplementedError('didnt implement ssl stream fetcher')
-
+                iteration_scheme=scheme),
+            buffers=buffers)
     return stream
 
 
@@ -1,3 +1,10 @@
+import multiprocessing
+import random
+import sys
+import threading
+import time
+import Queue
+from collections import deque
 import numpy as np
 from fuel.transformers import Transformer
 from fuel.streams import DataStream
@@ -53,16 +60,113 @@ class UpsampleToShape(Transformer):
         pass
 
 
-class Float32(Transformer):
-    def __init__(self, *args, **kwargs):
+class LookupNormalization(object):
+    """
+        uint8 to float32 normalization with a 256 entries table, the whole conversion is
+        one np.take written in the output instead of an astype, a - and a / each making a
+        full size temporary. Other dtypes are converted in place in the output.
+
+        normalization := None (values unchanged), '01' or '-1+1'
+        mean, std := optional, per channel (on axis) or scalar, applied after the
+        normalization. They are folded in one table per channel.
+        buffers := if not None, the outputs are taken in turn from that many preallocated
+        arrays (by shape) instead of a new one per batch. A batch is then overwritten
+        buffers batches later, it has to be more than the number of batches kept alive
+        downstream (ex.: a Prefetch holds queue_size + 2).
+    """
+    scale_shift = {
+        None : (1., 0.),
+        '01' : (1. / 255., 0.),
+        '-1+1' : (1. / 127.5, -1.),
+    }
+
+    def __init__(self, normalization='01', mean=None, std=None, axis=1, buffers=None):
+        assert normalization in self.scale_shift.keys()
+        self.scale, self.shift = self.scale_shift[normalization]
+        self.axis = axis
+        self.buffers = buffers
+        self.rings = {}
+
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float64).ravel()
+        self.std = None if std is None else np.asarray(std, dtype=np.float64).ravel()
+        table = np.arange(256, dtype=np.float64) * self.scale + self.shift
+        # (channels, 256), one row when there is nothing per channel
+        table = table[None,:]
+        if self.mean is not None:
+            table = table - self.mean[:,None]
+        if self.std is not None:
+            table = table / self.std[:,None]
+        self.tables = table.astype(np.float32)
+
+
+    def get_output(self, shape):
+        if self.buffers is None:
+            return np.empty(shape, dtype=np.float32)
+        ring = self.rings.get(shape)
+        if ring is None:
+            ring = deque(np.empty(shape, dtype=np.float32) for i in range(self.buffers))
+            self.rings[shape] = ring
+        ring.rotate(-1)
+        return ring[0]
+
+
+    def channel_view(self, data, c):
+        index = [slice(None)] * data.ndim
+        index[self.axis] = c
+        return data[tuple(index)]
+
+
+    def __call__(self, data, out=None):
+        data = np.asarray(data)
+        if out is None:
+            out = self.get_output(data.shape)
+
+        if data.dtype == np.uint8:
+            if len(self.tables) == 1:
+                np.take(self.tables[0], data, out=out, mode='clip')
+            else:
+                for c in range(len(self.tables)):
+                    np.take(self.tables[c], self.channel_view(data, c),
+                            out=self.channel_view(out, c), mode='clip')
+            return out
+
+        np.copyto(out, data, casting='unsafe')
+        if self.scale != 1.:
+            out *= self.scale
+        if self.shift != 0.:
+            out += self.shift
+        shape = [1] * out.ndim
+        shape[self.axis] = -1
+        if self.mean is not None:
+            out -= self.mean.astype(np.float32).reshape(shape if len(self.mean) > 1 else 1)
+        if self.std is not None:
+            out /= self.std.astype(np.float32).reshape(shape if len(self.std) > 1 else 1)
+        return out
+
+
+class Normalize(Transformer):
+    """
+        Normalize the first source to float32 with a LookupNormalization,
+        see it for the arguments.
+    """
+    def __init__(self, data_stream, normalization='01', mean=None, std=None, axis=1,
+                 buffers=None, **kwargs):
         kwargs.setdefault('produces_examples', False)
-        super(Float32, self).__init__(*args, **kwargs)
+        super(Normalize, self).__init__(data_stream, **kwargs)
+        self.lookup = LookupNormalization(normalization, mean, std, axis, buffers)
 
     def transform_batch(self, batch):
-        data = batch[0].astype(np.float32)
+        data = self.lookup(batch[0])
         return [data]+list(batch[1:])
 
 
+class Float32(Normalize):
+    # uint to float, values unchanged
+    def __init__(self, *args, **kwargs):
+        kwargs['normalization'] = None
+        super(Float32, self).__init__(*args, **kwargs)
+
+
 class RemoveDtsetMean(Transformer):
     """
         Removes dataset mean from all members of the dataset. Used in vgg ( *old* no batch norm model)
@@ -105,17 +209,12 @@ class From01tomin11(Transformer):
         return [data]+list(batch[1:])
 
 
-class Normalize_min1_1(Transformer):
+class Normalize_min1_1(Normalize):
     # uint to -1+1
     def __init__(self, *args, **kwargs):
-        kwargs.setdefault('produces_examples', False)
+        kwargs['normalization'] = '-1+1'
         super(Normalize_min1_1, self).__init__(*args, **kwargs)
 
-    def transform_batch(self, batch):
-        data = batch[0].astype(np.float32)
-        data = (data - 127.5) / 127.5
-        return [data]+list(batch[1:])
-
 
 class InsertLabeledExamples(Transformer):
     def __init__(self, dataset, nb_class, nb_examples, examples_per_class, *args, **kwargs):
@@ -129,6 +228,7 @@ class InsertLabeledExamples(Transformer):
         self.nb_examples = nb_examples
         self.total_examples = examples_per_class * nb_class
         self.current_slice_index = 0
+        self.lookup = LookupNormalization('01' if norm01 else '-1+1')
 
         # build a list of indexes on which we will loop with the original stream
         print "Building labeled examples indexes list..."
@@ -177,13 +277,11 @@ class InsertLabeledExamples(Transformer):
             self.current_slice_index += self.nb_examples
 
         data, targets = self.dataset.get_data(state=None, request=indexes)
-        if self.norm01 :
-            data = data.astype(np.float32) / 255.
-        else:
-            data = data.astype(np.float32)
-            data = (data - 127.5) / 127.5
-
-        data = np.concatenate([data, batch[0]], axis=0)
+        # the labeled examples are normalized directly in the output, no concatenate
+        out = np.empty((len(data) + len(batch[0]),) + data.shape[1:], dtype=np.float32)
+        self.lookup(data, out=out[:len(data)])
+        out[len(data):] = batch[0]
+        data = out
         #targets = np.concatenate([targets, batch[1]], axis=0)
 
         return [data, targets]
@@ -224,7 +322,269 @@ class ReLabelLabels(Transformer):
 
 
 
+class Prefetch(Transformer):
+    """
+        Produce the batches of data_stream in a background thread, up to queue_size
+        batches in advance, so the reads, fancy indexing and transformers upstream
+        run while the training thread computes. The time the consumer spent waiting
+        on the queue is in blocked_time (last epoch) and total_blocked_time.
+    """
+    def __init__(self, data_stream, queue_size=2, verbose=True, **kwargs):
+        kwargs.setdefault('produces_examples', data_stream.produces_examples)
+        super(Prefetch, self).__init__(data_stream, **kwargs)
+        self.queue_size = queue_size
+        self.verbose = verbose
+        self.total_blocked_time = 0.
+        self.blocked_time = 0.
+        self._stop = None
+
+
+    def _produce(self, iterator, queue, stop):
+        try:
+            for data in iterator:
+                while not stop.is_set():
+                    try:
+                        queue.put((data, None), timeout=0.1)
+                        break
+                    except Queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            item = (StopIteration, None)
+        except Exception:
+            # re raised in the training thread
+            item = (None, sys.exc_info())
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                continue
+
+
+    def _consume(self, queue):
+        self.blocked_time = 0.
+        n_batches = 0
+        while True:
+            t0 = time.time()
+            data, exc_info = queue.get()
+            self.blocked_time += time.time() - t0
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if data is StopIteration:
+                break
+            n_batches += 1
+            yield data
+
+        self.total_blocked_time += self.blocked_time
+        if self.verbose:
+            print "Prefetch: blocked {:.2f}s waiting on data over {} batches".format(
+                self.blocked_time, n_batches)
+
+
+    def get_epoch_iterator(self, **kwargs):
+        # an epoch left before its end leaves a producer behind, stop it
+        if self._stop is not None:
+            self._stop.set()
+        self._stop = threading.Event()
+        queue = Queue.Queue(maxsize=self.queue_size)
+        producer = threading.Thread(
+            target=self._produce,
+            args=(self.data_stream.get_epoch_iterator(), queue, self._stop))
+        producer.daemon = True
+        producer.start()
+
+        self.child_epoch_iterator = self._consume(queue)
+        # skip Transformer.get_epoch_iterator, the child iterator is the queue
+        return super(Transformer, self).get_epoch_iterator(**kwargs)
+
+
+    def transform_example(self, example):
+        return example
+
+
+    def transform_batch(self, batch):
+        return batch
+
+
+
+# state of a MultiProcessTransformer worker, set at the fork by _init_worker
+_worker = {}
+
+def _init_worker(transformers, slots):
+    _worker['transformers'] = transformers
+    _worker['slots'] = slots
+
+
+def _transform_in_worker(batch, seed, slot_id):
+    # seeded by batch, not by worker, the output does not depend on which worker got it
+    np.random.seed(seed)
+    random.seed(seed)
+    for transformer in _worker['transformers']:
+        batch = transformer.transform_batch(batch)
+
+    slot = None if slot_id is None else _worker['slots'][slot_id]
+    out = [] ; offset = 0
+    for data in batch:
+        data = np.asarray(data)
+        if slot is not None and data.dtype != object and offset + data.nbytes <= len(slot):
+            view = np.frombuffer(slot, dtype=data.dtype, count=data.size, offset=offset)
+            view[...] = data.ravel()
+            out += [(data.dtype.str, data.shape, offset)]
+            # keep every array 64 bytes aligned
+            offset += (data.nbytes + 63) // 64 * 64
+        else:
+            # does not fit, this one gets pickled back
+            out += [data]
+    return out
+
+
+
+class MultiProcessTransformer(Transformer):
+    """
+        Apply the transformers stacked in data_stream (ex.: Normalize_min1_1(DataStream(..)))
+        in a pool of forked processes. The batches are read by the innermost stream in this
+        process, sent to the workers and given back in order, up to max_pending in flight.
+
+        Every batch is transformed with np.random and random seeded from (seed, epoch,
+        batch index), so an epoch is the same whatever the number of processes. The
+        outputs come back through shared memory slots (sized on the first batch)
+        instead of being pickled.
+
+        Each worker has its own fork time copy of the transformers, a transformer
+        with a state (ex.: InsertLabeledExamples position in its list) updates it in
+        the worker only.
+    """
+    def __init__(self, data_stream, processes=4, seed=1234, max_pending=None, **kwargs):
+        kwargs.setdefault('produces_examples', False)
+        super(MultiProcessTransformer, self).__init__(data_stream, **kwargs)
+        self.processes = processes
+        self.seed = seed
+        self.max_pending = 2 * processes if max_pending is None else max_pending
+        self.epoch = 0
+        self.pool = None
+        self.pending = deque()
+
+        self.transformers = []
+        stream = data_stream
+        while isinstance(stream, Transformer) and \
+                not isinstance(stream, (Prefetch, MultiProcessTransformer)):
+            if stream.produces_examples:
+                raise ValueError("{} produces examples, only batches can be sent to the "
+                                 "workers".format(stream.__class__.__name__))
+            self.transformers.insert(0, stream)
+            stream = stream.data_stream
+        # the one which reads the data
+        self.source_stream = stream
+
+
+    def start_pool(self, batch):
+        """
+            The slots are sized from a first batch, they have to exist before the fork
+            so every worker can write in them.
+        """
+        for transformer in self.transformers:
+            batch = transformer.transform_batch(batch)
+        nbytes = sum((np.asarray(data).nbytes + 63) // 64 * 64 for data in batch)
+        self.slots = [multiprocessing.RawArray('b', nbytes) for i in range(self.max_pending)]
+        self.pool = multiprocessing.Pool(self.processes, initializer=_init_worker,
+                                         initargs=(self.transformers, self.slots))
+
+
+    def close(self):
+        # let the workers finish their writes in the slots before killing them
+        for slot_id, result in self.pending:
+            result.wait()
+        self.pending = deque()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        super(MultiProcessTransformer, self).close()
+
+
+    def read(self, out, slot_id):
+        batch = []
+        for data in out:
+            if isinstance(data, tuple):
+                dtype, shape, offset = data
+                dtype = np.dtype(dtype)
+                view = np.frombuffer(self.slots[slot_id], dtype=dtype,
+                                     count=int(np.prod(shape)), offset=offset)
+                # the slot gets reused, the consumer gets its own copy (a memcpy)
+                data = view.reshape(shape).copy()
+            batch += [data]
+        return tuple(batch)
+
+
+    def _transform(self, iterator, epoch):
+        pending = self.pending
+        free_slots = range(self.max_pending)
+        base_seed = self.seed + 1000003 * epoch
+        for i, batch in enumerate(iterator):
+            if self.pool is None:
+                self.start_pool(batch)
+            if len(pending) >= self.max_pending:
+                slot_id, result = pending.popleft()
+                yield self.read(result.get(), slot_id)
+                free_slots.append(slot_id)
+            slot_id = free_slots.pop()
+            result = self.pool.apply_async(_transform_in_worker,
+                                           (batch, base_seed + i, slot_id))
+            pending.append((slot_id, result))
+
+        while len(pending) > 0:
+            slot_id, result = pending.popleft()
+            yield self.read(result.get(), slot_id)
+            free_slots.append(slot_id)
+
+
+    def get_epoch_iterator(self, **kwargs):
+        # an epoch left before its end can still have workers writing in the slots
+        for slot_id, result in self.pending:
+            result.wait()
+        self.pending = deque()
+        self.child_epoch_iterator = self._transform(
+            self.source_stream.get_epoch_iterator(), self.epoch)
+        self.epoch += 1
+        # skip Transformer.get_epoch_iterator, the child iterator is the pool
+        return super(Transformer, self).get_epoch_iterator(**kwargs)
+
+
+    def transform_batch(self, batch):
+        return batch
+
+
+
 if __name__ == '__main__':
+    def time_function(f, inputs, n_runs=10):
+        f(*inputs)
+        t0 = time.time()
+        for i in range(n_runs):
+            f(*inputs)
+        return (time.time() - t0) / n_runs
+
+    npx = np.random.randint(256, size=(128,3,32,32)).astype(np.uint8)
+    def astype_normalization(data):
+        data = data.astype(np.float32)
+        return (data - 127.5) / 127.5
+    for buffers in [None, 2]:
+        lookup = LookupNormalization('-1+1', buffers=buffers)
+        assert np.allclose(astype_normalization(npx), lookup(npx), atol=1e-6)
+        print "-1+1 {} (buffers={}): astype {:.2f}ms, lookup {:.2f}ms".format(
+            npx.shape, buffers, time_function(astype_normalization, [npx]) * 1e3,
+            time_function(lookup, [npx]) * 1e3)
+
+    mean = np.array([0.49, 0.48, 0.45]) ; std = np.array([0.25, 0.24, 0.26])
+    def astype_standardization(data):
+        data = data.astype(np.float32) / 255.
+        return (data - mean[None,:,None,None]) / std[None,:,None,None]
+    lookup = LookupNormalization('01', mean, std, buffers=2)
+    assert np.allclose(astype_standardization(npx), lookup(npx), atol=1e-5)
+    print "01 and mean/std {}: astype {:.2f}ms, lookup {:.2f}ms".format(
+        npx.shape, time_function(astype_standardization, [npx]) * 1e3,
+        time_function(lookup, [npx]) * 1e3)
+
     from fuel.datasets import CIFAR10
     from fuel.schemes import ShuffledScheme
     from fuel.streams import DataStream